@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+# Helpers shared by the benchmarks in this directory: pointing YAPS to a
+# scratch instance, synthetic batches (in the format described in the README)
+# and reporting.
+
+import sys
+from os import environ, makedirs, urandom
+from os.path import abspath, dirname, join, getsize, exists
+from hashlib import sha256
+import tempfile
+import tarfile
+import json
+import io
+
+CGI_PATH = join(dirname(dirname(abspath(__file__))), 'cgi')
+
+# the example of the README
+DEFAULT_CFG = {
+    "version": 1,
+    "project": "YAPS-BENCH",
+    "endpoints": {
+        "ota": {
+            "url": "https://ota.example.org:4443",
+            "files": [
+                {"name": "ca.crt", "type": "static"},
+                {"name": "sig.pub", "type": "static"},
+            ],
+        },
+        "mqtt": {
+            "files": [
+                {"name": "ca.crt", "type": "static"},
+                {"name": "key", "type": "dynamic"},
+                {"name": "crt", "type": "dynamic"},
+            ],
+            "host": "mqtt.example.org",
+            "port": 8883,
+        },
+        "random": {
+            "files": [
+                {"type": "dynamic"},
+            ],
+        },
+    },
+}
+
+def setup(prefix=None):
+    """Point YAPS to `prefix` (a fresh temporary directory if omitted) via
+    its environment variables - which needs to happen before `provsys` gets
+    imported, so it's imported here and returned along with the prefix."""
+    prefix = (prefix or tempfile.mkdtemp(prefix='yaps-bench-')).rstrip('/')
+    for elem in ('PROV', 'IMPORT', 'EXPORT'):
+        makedirs(join(prefix, elem), exist_ok=True)
+    environ['YAPS_PREFIX'] = prefix
+    environ['YAPS_CACHE'] = prefix + '/cache/'
+    environ['YAPS_JOBS'] = prefix + '/jobs/'
+    environ['YAPS_METRICS'] = prefix + '/metrics/'
+    environ.setdefault('YAPS_LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, CGI_PATH)
+    import provsys
+    return provsys, prefix
+
+def files(cfg, file_type):
+    # same naming as `ProvSystem.get_{static,dynamic}_files()`
+    res = []
+    for endpoint_key, endpoint_val in cfg['endpoints'].items():
+        for file1 in endpoint_val.get('files', []):
+            if file1['type'] == file_type:
+                res.append("{}.{}".format(endpoint_key, file1['name']) if 'name' in file1 else endpoint_key)
+    return res
+
+def make_cfg(dynamic):
+    """Config with `dynamic` dynamic files (and a single static one)."""
+    return {
+        "version": 1,
+        "project": "YAPS-BENCH",
+        "endpoints": {
+            "bench": {
+                "files": [{"name": "ca.crt", "type": "static"}] + [{"name": "f{}".format(i), "type": "dynamic"} for i in range(dynamic)],
+            },
+        },
+    }
+
+def write_batch(path, cfg, sets, sizes={}, size=1024, start=0, static_size=1024, compression='gz'):
+    """Write an import archive of `sets` sets to `path`, dynamic files being
+    random data of `size` bytes (or as given per file in `sizes`).
+    Secret and static files are derived from the project name, so batches
+    written for the same config can be imported into the same instance."""
+    def add(tar_fd, name, content):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar_fd.addfile(info, io.BytesIO(content))
+
+    def add_dir(tar_fd, name):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar_fd.addfile(info)
+
+    seed = sha256(bytes(cfg['project'], 'utf-8')).digest()
+    with tarfile.open(path, 'w:' + ('' if compression == 'none' else compression)) as tar_fd:
+        add(tar_fd, "config.json", bytes(json.dumps(cfg, indent=2), 'utf-8'))
+        add(tar_fd, "secret", seed)
+        for static_file in files(cfg, 'static'):
+            add(tar_fd, static_file, (sha256(seed + bytes(static_file, 'utf-8')).digest() * (static_size // 32 + 1))[:static_size])
+        add_dir(tar_fd, "sets")
+        for i in range(start, start + sets):
+            set_id = "{:08d}".format(i)
+            add_dir(tar_fd, "sets/{}".format(set_id))
+            for dyn_file in files(cfg, 'dynamic'):
+                add(tar_fd, "sets/{}/{}".format(set_id, dyn_file), urandom(sizes.get(dyn_file, size)))
+
+def db_size(provsys):
+    return sum(getsize(provsys.LOCAL_PATH_DB + suffix) for suffix in ('', '-wal') if exists(provsys.LOCAL_PATH_DB + suffix))
+
+def percentile(values, p):
+    # nearest rank
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))]
+
+def latency(values):
+    """Summary of latencies `values` (in seconds), in milliseconds."""
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 3) if values else None,
+        'max_ms': round(max(values) * 1000, 3) if values else None,
+    }
+
+def report(res, as_json=False):
+    if as_json:
+        print(json.dumps(res, indent=2))
+        return
+    def _print(res, indent=0):
+        for key, val in res.items():
+            if isinstance(val, dict):
+                print("{}{}:".format(' ' * indent, key))
+                _print(val, indent + 2)
+            else:
+                print("{}{}: {}".format(' ' * indent, key, val))
+    _print(res)
@@ -1,41 +1,177 @@
 #!/usr/bin/python3
 
-import subprocess
-from re import search as re_compile
+# State of the OpenWrt box YAPS runs on: block devices mounted and DHCP leases
+# handed out to devices. Both are asked for with every `/status` poll, so they
+# are cached and only gathered anew once they (might) have changed.
+
+from os import environ, remove, stat
+from hashlib import sha256
+from time import time
 from sys import stderr
+import subprocess
+import json
+
+import provfiles
+
+CACHE_PATH = environ.get('YAPS_CACHE', '/tmp/yaps-cache/')
+# output of `block info`, keyed by the mounts it was taken with; removed by the
+# hotplug hook (see README) whenever block devices come or go
+BLOCK_CACHE = CACHE_PATH + "block.json"
+BLOCK_MAX_AGE = 300 # seconds, just in case an event got missed
+PROC_MOUNTS = "/proc/mounts"
+
+# leases of dnsmasq and odhcpd (its `leasefile` as configured by default)
+DHCP_LEASES_DNSMASQ = "/tmp/dhcp.leases"
+DHCP_LEASES_ODHCPD = "/tmp/hosts/odhcpd"
+# leases parsed, keyed by lease file along with its mtime and size
+LEASES_CACHE = CACHE_PATH + "leases.json"
+
+def _write_cache(path, data):
+    # concurrent polls might refresh a cache at the same time
+    try:
+        provfiles.write_json(path, data)
+    except OSError as exc:
+        print("Can't write cache {}: {}".format(path, exc), file=stderr)
+
+def _parse_dnsmasq(lines):
+    # <expiry> <mac> <ip> <hostname> <client id>
+    leases = []
+    for line in lines:
+        split = line.split()
+        if len(split) < 4:
+            continue
+        leases.append({'mac': split[1], 'ip': split[2], 'name': split[3]})
+    return leases
+
+def _parse_odhcpd(lines):
+    # Lease lines are comments in between host entries:
+    # # <interface> <mac or DUID> <"ipv4" or IAID> <hostname> <valid until> <assigned> <prefix length> <address/length> ..
+    leases = []
+    for line in lines:
+        split = line.split()
+        if len(split) < 9 or split[0] != '#':
+            continue
+        ipv4 = split[3] == 'ipv4'
+        mac = ':'.join(split[2][i:i + 2] for i in range(0, len(split[2]), 2)) if ipv4 else None
+        for addr in split[8:]:
+            leases.append({'mac': mac, 'ip': addr.split('/')[0], 'name': split[4] if split[4] != '-' else ''})
+    return leases
 
 class DHCP():
+    sources = ((DHCP_LEASES_DNSMASQ, _parse_dnsmasq), (DHCP_LEASES_ODHCPD, _parse_odhcpd))
+
     def __init__(self):
         self.leases = []
 
+    def _cached(self):
+        try:
+            with open(LEASES_CACHE, 'r') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
     def fetch(self):
-        #TODO: This relies on dnsmasq, while there are multiple DHCP server implementation within OpenWrt (mainly odhcpd)
+        """Leases of whichever DHCP servers are running, each lease file only
+        parsed again once its mtime (or size) changed."""
         self.leases = []
-        lines = open("/tmp/dhcp.leases", "r").readlines()
-        for line in lines:
-            if not line.strip():
+        cache = self._cached()
+        fresh = {}
+        for path, parse in self.sources:
+            try:
+                st = stat(path)
+            except OSError:
                 continue
-            split = line.split(' ')
-            self.leases.append({'mac': split[1], 'ip': split[2], 'name': split[3]})
+            key = [st.st_mtime_ns, st.st_size]
+            entry = cache.get(path)
+            if not entry or entry.get('key') != key:
+                try:
+                    with open(path, 'r') as fd:
+                        entry = {'key': key, 'leases': parse(fd.readlines())}
+                except OSError:
+                    continue
+            fresh[path] = entry
+            self.leases += entry['leases']
+        if fresh != cache:
+            _write_cache(LEASES_CACHE, fresh)
 
 class FStools():
     def __init__(self):
-        self.result = ''
+        self.devices = []
+        self.labels = {}
+        self.uuids = {}
+        self.paths = {}
+
+    def _mounts(self):
+        try:
+            with open(PROC_MOUNTS, 'rb') as fd:
+                return sha256(fd.read()).hexdigest()
+        except OSError:
+            return None
+
+    def _cached(self, mounts):
+        try:
+            with open(BLOCK_CACHE, 'r') as fd:
+                cache = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        if cache.get('mounts') != mounts or time() - cache.get('fetched', 0) > BLOCK_MAX_AGE:
+            return None
+        return cache['devices']
+
+    def _cache(self, mounts, devices):
+        _write_cache(BLOCK_CACHE, {'mounts': mounts, 'fetched': time(), 'devices': devices})
+
+    def parse(self, result):
+        # /dev/sda1: UUID="2a1c-33f0" LABEL="PROV" VERSION="FAT32" MOUNT="/PROV" TYPE="vfat"
+        devices = []
+        for line in result.splitlines():
+            path, sep, attrs = line.partition(': ')
+            if not sep:
+                continue
+            device = {'device': path}
+            for attr in attrs.split('" '):
+                key, sep, val = attr.partition('="')
+                if sep:
+                    device[key.strip()] = val.rstrip('"')
+            devices.append(device)
+        return devices
 
     def fetch(self):
-        proc = subprocess.Popen("/sbin/block info", stdout=subprocess.PIPE, shell=True)
-        self.result = proc.communicate()[0].decode("utf-8")
+        """Block devices as reported by `block info` - only run again once the
+        mounts changed, a hotplug event got seen or BLOCK_MAX_AGE passed."""
+        mounts = self._mounts()
+        devices = self._cached(mounts)
+        if devices is None:
+            proc = subprocess.run(["/sbin/block", "info"], stdout=subprocess.PIPE)
+            devices = self.parse(proc.stdout.decode("utf-8"))
+            self._cache(mounts, devices)
+        self.devices = devices
+        # only mounted ones are of interest, see `mounted()`
+        mounted = [device for device in devices if device.get('MOUNT')]
+        # vfat labels come padded with spaces
+        self.labels = {device['LABEL'].strip(): device for device in mounted if 'LABEL' in device}
+        self.uuids = {device['UUID']: device for device in mounted if 'UUID' in device}
+        self.paths = {device['device']: device for device in mounted}
 
     def mounted(self, fslabel=None, uuid=None, device=None):
         if not (fslabel or uuid or device):
             raise Exception("must provide either fslabel or uuid or device")
 
         if fslabel:
-            #return True if re_compile("LABEL=\"(%s)\"" % fslabel, self.result) else False
-            return True if re_compile('LABEL="(%s) *.?".*MOUNT="(.*)"' % fslabel, self.result) else False
+            return fslabel in self.labels
 
         if uuid:
-            return True if re_compile("UUID=\"(%s)\".*MOUNT=\"(.*)\"" % uuid, self.result) else False
+            return uuid in self.uuids
 
         if device:
-            return True if re_compile("^(%s): .*MOUNT=\"(.*)\"" % uuid, self.result) else False
+            return device in self.paths
+
+def invalidate():
+    # called by the hotplug hook, see README
+    try:
+        remove(BLOCK_CACHE)
+    except OSError:
+        pass
+
+if __name__ == '__main__':
+    invalidate()
@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+
+# Device API shared by the CGI entry point (`prov`) and the persistent server
+# (`provd`). Calls don't write to stdout themselves but return
+# (status, headers, body), so both frontends can put it on the wire their way.
+
+import provsys
+import provmetrics
+
+from os import sendfile
+from sys import stderr
+from time import perf_counter
+import errno
+import json
+
+tarfile = provsys.lazy_import('tarfile')
+
+SENDFILE_MIN = 65536 # static files at least that large are sent straight from disk, see `write()`
+
+def dumps(args):
+    return json.dumps(args, indent=2,separators=(',', ': '))
+
+class FrontendError(provsys.ProvSysError):
+    """Frontend sent sunsupported data.
+    Will result in HTP 400 / Bad Request"""
+
+class Stream():
+    """Response body handed out in chunks rather than as a whole, optionally
+    with a status other than 200 and additional headers"""
+    def __init__(self, chunks, content_type, length=None, status="200 OK", headers=()):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.length = length
+        self.status = status
+        self.headers = list(headers)
+
+class FileStream(Stream):
+    """Response body being `length` bytes of the local file `path` starting
+    at `offset`, to be sent by the frontend without passing through Python
+    buffers, see `write()`"""
+    def __init__(self, path, offset, length, content_type, status="200 OK", headers=()):
+        super().__init__(None, content_type, length, status, headers)
+        self.path = path
+        self.offset = offset
+
+def _tar_stream(members):
+    """Plain (uncompressed) ustar archive of `members`, a list of (name, content).
+    Chosen for devices to be able to process it incrementally: a 512 byte
+    header per member followed by its content padded to 512 bytes."""
+    chunks = []
+    for name, content in members:
+        content = content if type(content) == bytes else bytes(str(content), 'utf-8')
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        chunks.append(info.tobuf(tarfile.USTAR_FORMAT))
+        chunks.append(content)
+        if len(content) % tarfile.BLOCKSIZE:
+            chunks.append(tarfile.NUL * (tarfile.BLOCKSIZE - len(content) % tarfile.BLOCKSIZE))
+    chunks.append(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+    return Stream(chunks, "application/x-tar", sum(len(chunk) for chunk in chunks))
+
+def check(prov, **args):
+    return prov.provsys.check_consistency_local()
+
+def get_hash(prov, **args):
+    return prov.fetch_hash()
+
+def _accepts_gzip(header):
+    # `Accept-Encoding`, e.g. "gzip, deflate;q=0.5" - listed without `q=0`
+    for coding in (header or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        params = params.replace(' ', '')
+        try:
+            return not params.startswith('q=') or float(params[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+def _compact(args):
+    return args.get('compact') not in (None, '', '0')
+
+def _config(prov, **args):
+    prov.fetch_config()
+    return prov.provsys.get_config_body(_compact(args))
+
+def get_config(prov, **args):
+    # pretty-printed unless `compact` is given, precompressed (see
+    # `ProvSystem.index_static_files()`) for devices accepting it
+    body = bytes(_config(prov, **args), 'utf-8')
+    headers = [("Vary", "Accept-Encoding")]
+    if _accepts_gzip(prov.environ.get('HTTP_ACCEPT_ENCODING')):
+        compressed = prov.provsys.get_config_gzip(_compact(args))
+        if compressed:
+            body = compressed
+            headers.append(("Content-Encoding", "gzip"))
+    return Stream([body], "text/plain", len(body), headers=headers)
+
+def get_static_file(prov, **args):
+    return True
+
+def get_dynamic_file(prov, **args):
+    return True
+
+def get_endpoints_file_dynamic(prov, **args):
+    if 'file' not in args:
+        raise FrontendError("Missing file argument")
+    hier = args['file'].split('.', 1)
+    try:
+        if hier[-1] not in prov.fetch_config()['endpoints'][hier[0]]['files']['dynamic']:
+            raise KeyError
+    except KeyError:
+        raise FrontendError("Requested file unknown")
+
+    return prov.read_file("{}.{}".format(hier[0], hier[-1]))
+
+def _etag_matches(header, etag):
+    # `If-None-Match` uses the weak comparison
+    return bool(header) and any(tag.strip() in ('*', etag, 'W/' + etag) for tag in header.split(','))
+
+def _byte_range(header, size):
+    """(first, last) byte requested by `Range` header `header`; `None` if
+    there's none or it's not supported (anything but a single range), `False`
+    if it can't be satisfied."""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            # suffix: the last N bytes
+            return (max(size - int(last), 0), size - 1) if int(last) else False
+        first, last = int(first), int(last) if last else None
+    except ValueError:
+        return None
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        return False
+    return first, size - 1 if last is None else min(last, size - 1)
+
+def _get_endpoints_file_static(prov, file_name):
+    # Devices re-requesting a file they already have (`If-None-Match` holding
+    # its ETag - the digest precomputed by `ProvSystem.index_static_files()`)
+    # get a 304 without body, interrupted downloads can be resumed via `Range`.
+    # Devices accepting it get the precompressed variant, being a
+    # representation of its own: ETag, size and ranges refer to that one.
+    if file_name == 'secret':
+        raise FrontendError("Requested protected file")
+    info = prov.provsys.get_static_file_info(file_name)
+    etag = '"{}"'.format(info['sha256'])
+    local_file = file_name
+    headers = [("Vary", "Accept-Encoding")]
+    if info['gzip'] and _accepts_gzip(prov.environ.get('HTTP_ACCEPT_ENCODING')):
+        etag = '"{}+gzip"'.format(info['sha256'])
+        local_file = file_name + provsys.GZIP_SUFFIX
+        info = dict(info, size=info['gzip'], path=info['path'] + provsys.GZIP_SUFFIX)
+        headers.append(("Content-Encoding", "gzip"))
+    headers += [("ETag", etag), ("Accept-Ranges", "bytes")]
+    if _etag_matches(prov.environ.get('HTTP_IF_NONE_MATCH'), etag):
+        return Stream([], None, status="304 Not Modified", headers=headers)
+
+    byte_range = None
+    if prov.environ.get('HTTP_IF_RANGE', etag) == etag:
+        byte_range = _byte_range(prov.environ.get('HTTP_RANGE'), info['size'])
+    if byte_range is False:
+        return Stream([], None, 0, "416 Range Not Satisfiable", headers + [("Content-Range", "bytes */{}".format(info['size']))])
+    status = "200 OK"
+    offset, length = 0, info['size']
+    if byte_range:
+        status = "206 Partial Content"
+        offset, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+        headers.append(("Content-Range", "bytes {}-{}/{}".format(byte_range[0], byte_range[1], info['size'])))
+
+    if info['size'] >= SENDFILE_MIN:
+        return FileStream(info['path'], offset, length, "text/plain", status, headers)
+    # small ones are rather kept in memory, see `provd`
+    return Stream([prov.read_file(local_file)[offset:offset + length]], "text/plain", length, status, headers)
+
+def _get_endpoints_file_dynamic(prov, property_name):
+    return prov.lookup(property_name)[0]
+
+def get_endpoints_file(prov, **args):
+    try:
+        type1, file1 = args['file'].split('/', 1)
+        hier = file1.split('.', 1)
+        if type1 == 'dynamic' and file1 in prov.provsys.get_dynamic_files():
+            return _get_endpoints_file_dynamic(prov, file1)
+        if type1 == 'static' and file1 in prov.provsys.get_static_files():
+            return _get_endpoints_file_static(prov, file1)
+        raise Exception() # nothing found
+    except provsys.ProvSysError:
+        raise
+    except:
+        raise FrontendError("Requested resource not found")
+
+def get_bundle(prov, **args):
+    # All of `getConfig`, `getHash`, `getFile` (for every file) and - if the
+    # `done` argument is given - `setDone` in one go.
+    members = [
+        ("config.json", _config(prov, **args)),
+        ("hash", prov.fetch_hash()),
+    ]
+    for static_file in prov.provsys.get_static_files():
+        members.append(("static/{}".format(static_file), prov.provsys.read_local_file(static_file)))
+    dynamic_files = prov.provsys.get_dynamic_files()
+    for dynamic_file, content in zip(dynamic_files, prov.lookup(*dynamic_files)):
+        members.append(("dynamic/{}".format(dynamic_file), content))
+    if args.get('done') not in (None, '', '0'):
+        members.append(("done", prov.set_done()))
+    return _tar_stream(members)
+
+def set_done(prov, **args):
+    #return prov.set_done(prod_id=args['prod_id'], fw_ver=args['fw_ver'])
+    return prov.set_done()
+
+def calls(call):
+    _calls = {
+        "/check": check,
+        "/getHash": get_hash,
+        "/getConfig": get_config,
+        "/getFile": get_endpoints_file,
+        "/getBundle": get_bundle,
+        "/setDone": set_done,
+    }
+    if call not in _calls:
+        raise provsys.ProvisioningError("Call not supported by this provisioning system")
+    return _calls.get(call)
+
+def _error(status, e):
+    print(e, file=stderr)
+    body = bytes(dumps({'class': e.__class__.__name__ , 'msg': e.msg, 'verb': e.verb}), 'utf-8')
+    return status, [("Content-Type", "text/json"), ("Content-Length", str(len(body)))], [body]
+
+def handle(pathinfo, params, system=None, environ=None):
+    start = perf_counter()
+    res = _handle(pathinfo, params, system, environ)
+    try:
+        calls(pathinfo)
+        route = pathinfo
+    except provsys.ProvisioningError:
+        route = 'other' # not to have a metric per garbage URL requested
+    provmetrics.observe('yaps_request_seconds', perf_counter() - start, route=route)
+    provmetrics.inc('yaps_requests_total', route=route, status=res[0].split(' ')[0])
+    return res
+
+def store(params):
+    """Project store a call is to be served from, see `provsys.select_store()`."""
+    return provsys.select_store(params.get('project'), params.get('prod_id'))
+
+def _handle(pathinfo, params, system=None, environ=None):
+    """Process a single device call.
+    `system` is an already set up `ProvSystem` of the store the call belongs
+    to (see `store()`) to be reused (see `provd`); if omitted, a fresh one is
+    created and checked for consistency.
+    `environ` holds the request headers CGI-style (`HTTP_IF_NONE_MATCH`, ..).
+    Returns a tuple of (status, list of (header, value), body), body being a
+    list of bytes or a `FileStream` - either way to be sent via `write()`."""
+    try:
+        try:
+            prov = provsys.Provisioning(params['dev_id'], params['prod_id'], params['fw_ver'], system=system, store=None if system else store(params))
+            #prov.set_dev_params(params['dev_id'], params['prod_id'], params['fw_ver'])
+        except KeyError:
+            raise FrontendError("Missing device arguments")
+        #prov.fetch_set()
+        prov.environ = environ or {}
+        resp = calls(pathinfo)(prov, **params)
+        if isinstance(resp, Stream):
+            headers = []
+            if resp.content_type:
+                headers.append(("Content-Type", resp.content_type))
+            if resp.length is not None:
+                headers.append(("Content-Length", str(resp.length)))
+            return resp.status, headers + resp.headers, resp if isinstance(resp, FileStream) else resp.chunks
+        resp = resp if type(resp) == bytes else bytes(str(resp), 'utf-8')
+        return "200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(resp)))], [resp]
+    except FrontendError as e:
+        return _error("400 BadRequest", e)
+    except provsys.ProvisioningError as e:
+        return _error("500 ProvisioningError", e)
+    except provsys.ProvSysError as e:
+        return _error("500 ProvSysError", e)
+
+def write(body, out):
+    """Write `body` as returned by `handle()` to the binary file object `out`.
+    A `FileStream` is handed over to the kernel via `sendfile()`, falling back
+    to copying if `out` doesn't support that."""
+    if not isinstance(body, FileStream):
+        for chunk in body:
+            out.write(chunk)
+        return
+    out.flush()
+    with open(body.path, 'rb') as fd:
+        offset, remaining = body.offset, body.length
+        while remaining:
+            try:
+                sent = sendfile(out.fileno(), fd.fileno(), offset, remaining)
+            except OSError as exc:
+                if exc.errno not in (errno.EINVAL, errno.ENOSYS, errno.EBADF) or offset != body.offset:
+                    raise
+                fd.seek(offset)
+                while remaining:
+                    chunk = fd.read(min(remaining, SENDFILE_MIN))
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    remaining -= len(chunk)
+                return
+            if not sent:
+                break # file got truncated meanwhile
+            offset += sent
+            remaining -= sent
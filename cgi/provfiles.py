@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+
+# Writing files read by other processes (caches, job state, metrics) at the
+# same time: written next to their destination and only then renamed into
+# place, so readers never see partially written files. The temporary file is
+# one of the writing process (and thread, see `provd`), so concurrent writers
+# don't interfere with each other - the last one renamed wins.
+
+from os import getpid, makedirs, remove, rename
+from os.path import dirname, exists
+from threading import get_ident
+import json
+
+def tmp_path(path):
+    return "{}.tmp.{}.{}".format(path, getpid(), get_ident())
+
+def write_json(path, data):
+    """Write `data` to `path` as JSON, creating its directory if needed.
+    Raises OSError if that fails, leaving no temporary file behind."""
+    tmp = tmp_path(path)
+    try:
+        if not exists(dirname(path)):
+            makedirs(dirname(path))
+        with open(tmp, 'w') as fd:
+            json.dump(data, fd)
+        rename(tmp, path)
+    except:
+        try:
+            remove(tmp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+# Background jobs for long running management tasks (importing and scanning
+# batches, creating and restoring backups).
+#
+# CGI requests are subject to the webserver's script timeout, so instead of
+# doing the work within the request, `/import` (`/export`, `/restore`) only
+# queues a job and spawns a detached worker processing all queued jobs one
+# after another.
+# Jobs are plain JSON files in JOBS_PATH (tmpfs, not the PROV drive), updated
+# by the worker while running, and polled via `/jobs`.
+
+import provsys
+import provmetrics
+import provfiles
+
+from os import environ, listdir, makedirs, remove, devnull
+from os.path import exists
+from time import time, time_ns
+from sys import executable, stderr
+import fcntl
+import json
+import re
+
+subprocess = provsys.lazy_import('subprocess')
+random = provsys.lazy_import('random')
+string = provsys.lazy_import('string')
+
+JOBS_PATH = environ.get('YAPS_JOBS', '/tmp/yaps-jobs/')
+JOBS_LOCK = JOBS_PATH + "worker.lock"
+QUEUE_LOCK = JOBS_PATH + "queue.lock" # held while checking for and queueing jobs, see `submit()`
+JOBS_KEEP = 20 # number of finished jobs to keep around for being reported
+
+# interval (in seconds) progress of a running job is written out at
+PROGRESS_INTERVAL = 1
+
+# IDs as created by `submit()`: time submitted (ns) and a random suffix
+JOB_ID = re.compile(r'[0-9]+-[a-z0-9]{5}')
+
+def valid_id(job_id):
+    # job IDs end up in paths, see `_path()`
+    return isinstance(job_id, str) and JOB_ID.fullmatch(job_id) is not None
+
+def _path(job_id):
+    return "{}{}.json".format(JOBS_PATH, job_id)
+
+def _write(job):
+    provfiles.write_json(_path(job['id']), job)
+
+def _read(job_id):
+    with open(_path(job_id), 'r') as fd:
+        return json.load(fd)
+
+def jobs():
+    """All jobs known, in the order they were submitted."""
+    if not exists(JOBS_PATH):
+        return []
+    res = []
+    for elem in listdir(JOBS_PATH):
+        if elem.endswith(".json"):
+            try:
+                res.append(_read(elem[:-len(".json")]))
+            except (OSError, ValueError):
+                pass # vanished or being written in the meantime
+    return sorted(res, key=lambda job: job['submitted'])
+
+def get(job_id):
+    if not valid_id(job_id):
+        raise provsys.ProvSysError("{}: no such job".format(job_id))
+    try:
+        return _read(job_id)
+    except (OSError, ValueError):
+        raise provsys.ProvSysError("{}: no such job".format(job_id))
+
+def _prune():
+    finished = [job for job in jobs() if job['state'] in ('done', 'failed')]
+    for job in finished[:-JOBS_KEEP]:
+        try:
+            remove(_path(job['id']))
+        except OSError:
+            pass
+
+def submit(kind, targets, args={}, store=None, skip_pending=False):
+    """Queue a job of `kind` (see `_run()`) per target (batch to import,
+    backup to create or restore) of project store `store` and make sure a
+    worker is running.
+    Targets already queued (or running) raise - or are left out, given
+    `skip_pending`.
+    Returns the IDs of the jobs created."""
+    if not exists(JOBS_PATH):
+        makedirs(JOBS_PATH)
+    with open(QUEUE_LOCK, 'w') as lock:
+        # concurrent requests (e.g. `/status` polls) must not queue the same job twice
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        ids = _submit(kind, targets, args, store, skip_pending)
+    if ids:
+        spawn()
+    return ids
+
+def _submit(kind, targets, args, store, skip_pending):
+    _prune()
+    pending = [(job['kind'], job.get('store'), job['target']) for job in jobs() if job['state'] in ('queued', 'running')]
+    ids = []
+    for target in targets:
+        if (kind, store, target) in pending:
+            if skip_pending:
+                continue
+            raise provsys.ProvSysError("{}: already queued for {}".format(target, kind))
+        job = {
+            'id': "{:d}-{}".format(time_ns(), ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(5))),
+            'kind': kind,
+            'store': store,
+            'target': target,
+            'args': args,
+            'result': None,
+            'state': 'queued',
+            'submitted': time(),
+            'started': None,
+            'finished': None,
+            'processed': 0,
+            'total': None,
+            'rate': None,
+            'eta': None,
+            'error': None,
+        }
+        _write(job)
+        pending.append((kind, store, target))
+        ids.append(job['id'])
+    return ids
+
+def pending(kind, store=None, failed=False):
+    """Targets of the jobs of `kind` (and store) queued or running - and the
+    ones failed (as long as kept, see JOBS_KEEP) if `failed`."""
+    states = ('queued', 'running', 'failed') if failed else ('queued', 'running')
+    return [job['target'] for job in jobs() if job['kind'] == kind and job.get('store') == store and job['state'] in states]
+
+def spawn():
+    # fully detached, so the CGI request can return right away
+    with open(devnull, 'r+b') as fd:
+        subprocess.Popen([executable, __file__], stdin=fd, stdout=fd, stderr=fd, start_new_session=True, close_fds=True)
+
+def _run(job):
+    job['state'] = 'running'
+    job['started'] = time()
+    _write(job)
+    last = [0]
+
+    def progress(state):
+        job['processed'] = state['processed']
+        now = time()
+        if now - last[0] < PROGRESS_INTERVAL:
+            return
+        last[0] = now
+        elapsed = now - job['started']
+        job['rate'] = state['processed'] / elapsed if elapsed else None
+        # e.g. the number of sets within a (compressed) archive isn't known
+        # before having read all of it, so the total is extrapolated from how
+        # far the archive was read so far
+        if state['position']:
+            job['total'] = int(state['processed'] * state['size'] / state['position'])
+            job['eta'] = elapsed * (state['size'] - state['position']) / state['position']
+        _write(job)
+
+    try:
+        # fresh instance per job, as the previous one might have initialized the system
+        prov = provsys.ProvSystem(job.get('store'))
+        if job['kind'] == 'import':
+            prov.import_batch(job['target'], progress=progress)
+        elif job['kind'] == 'backup':
+            job['result'] = prov.backup(job['target'], progress=progress, **job['args'])
+        elif job['kind'] == 'restore':
+            prov.restore(job['target'], progress=progress)
+        elif job['kind'] == 'scan':
+            # failing rather than being queued again by every poll, see `/status`
+            prov.scan_batch(job['target'], strict=True)
+        else:
+            raise provsys.ProvSysError("{}: unknown kind of job".format(job['kind']))
+        job['state'] = 'done'
+        job['total'] = job['processed']
+        job['eta'] = 0
+    except provsys.ProvSysError as e:
+        print(e, file=stderr)
+        job['state'] = 'failed'
+        job['error'] = {'class': e.__class__.__name__, 'msg': e.msg, 'verb': e.verb}
+    except Exception as e:
+        print(e, file=stderr)
+        job['state'] = 'failed'
+        job['error'] = {'class': e.__class__.__name__, 'msg': str(e), 'verb': None}
+    job['finished'] = time()
+    elapsed = job['finished'] - job['started']
+    job['rate'] = job['processed'] / elapsed if elapsed else None
+    _write(job)
+
+def run():
+    """Worker: process queued jobs until there are none left. Only a single
+    worker is active at a time, others exit right away."""
+    with open(JOBS_LOCK, 'w') as lock:
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return # another worker is active and will pick up our jobs
+            try:
+                # holding the lock, jobs still marked as running belong to a
+                # worker which didn't make it to the end
+                for job in jobs():
+                    if job['state'] == 'running':
+                        job['state'] = 'failed'
+                        job['error'] = {'class': 'Interrupted', 'msg': "Job was interrupted", 'verb': None}
+                        _write(job)
+                while True:
+                    queued = [job for job in jobs() if job['state'] == 'queued']
+                    if not queued:
+                        break
+                    _run(queued[0])
+                    provmetrics.flush()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            # a job might have been queued after we looked the last time but
+            # before the lock was released, with its worker exiting right away
+            if not any(job['state'] == 'queued' for job in jobs()):
+                return
+
+if __name__ == '__main__':
+    run()
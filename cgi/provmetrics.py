@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+# Lightweight instrumentation: counters and latency histograms of the device
+# API, database queries and imports, exposed in Prometheus text format via
+# `/cgi/mgmt/metrics`, plus a sampled log of slow queries.
+#
+# Most requests are served by short-lived CGI processes, so every process only
+# collects in memory and adds its share to the totals kept in METRICS_PATH
+# (tmpfs) once done, see `flush()`.
+
+from os import environ, makedirs, rename, stat
+from os.path import exists
+from time import time
+from threading import Lock
+import fcntl
+import json
+
+import provfiles
+
+METRICS_PATH = environ.get('YAPS_METRICS', '/tmp/yaps-metrics/')
+METRICS_FILE = METRICS_PATH + "metrics.json"
+METRICS_LOCK = METRICS_PATH + "metrics.lock"
+SLOW_LOG = METRICS_PATH + "slow.log"
+SLOW_LOG_MAX = 65536 # size (in bytes) the slow query log is rotated at
+
+# queries taking longer (in seconds) are slow, of which only a share gets logged
+SLOW_QUERY = float(environ.get('YAPS_SLOW_QUERY', 0.1))
+SLOW_QUERY_SAMPLE = float(environ.get('YAPS_SLOW_QUERY_SAMPLE', 0.1))
+
+# upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+METRICS = {
+    'yaps_requests_total': ('counter', "Device API requests by route and status"),
+    'yaps_request_seconds': ('histogram', "Device API request latency by route"),
+    'yaps_query_seconds': ('histogram', "Database query time by statement and table"),
+    'yaps_query_rows_total': ('counter', "Database rows fetched or modified by statement and table"),
+    'yaps_query_retries_total': ('counter', "Writes retried due to the database being locked"),
+    'yaps_allocations_total': ('counter', "Sets allocated to devices (including repeated allocations to the same device)"),
+    'yaps_allocation_failures_total': ('counter', "Set allocations failed due to no free sets left"),
+    'yaps_imports_total': ('counter', "Batch imports by result"),
+    'yaps_import_sets_total': ('counter', "Sets imported"),
+    'yaps_import_seconds_total': ('counter', "Time spent importing batches"),
+    'yaps_sets': ('gauge', "Sets by state"),
+    'yaps_pool_exhausted': ('gauge', "Whether no free sets are left"),
+}
+
+_lock = Lock()
+_counters = {}
+_histograms = {}
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ','.join('{}="{}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"')) for key,val in sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    series = _series(name, labels)
+    with _lock:
+        _counters[series] = _counters.get(series, 0) + value
+
+def observe(name, value, **labels):
+    series = _series(name, labels)
+    with _lock:
+        hist = _histograms.setdefault(series, {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0})
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                hist['buckets'][i] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+
+def slow_query(duration, query, values):
+    """Log `query` if it took longer than SLOW_QUERY - one out of
+    1/SLOW_QUERY_SAMPLE of those, that is."""
+    if duration < SLOW_QUERY:
+        return
+    import random # only needed here, imported on demand to keep startup cheap
+    if random.random() >= SLOW_QUERY_SAMPLE:
+        return
+    try:
+        if not exists(METRICS_PATH):
+            makedirs(METRICS_PATH)
+        if exists(SLOW_LOG) and stat(SLOW_LOG).st_size > SLOW_LOG_MAX:
+            rename(SLOW_LOG, SLOW_LOG + ".1")
+        with open(SLOW_LOG, 'a') as fd:
+            fd.write("{:.3f} {:.6f}s {} / {}\n".format(time(), duration, ' '.join(query.split()), values))
+    except OSError:
+        pass
+
+def _read():
+    try:
+        with open(METRICS_FILE, 'r') as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {'counters': {}, 'histograms': {}}
+
+def flush():
+    """Add what was collected by this process so far to the totals."""
+    with _lock:
+        if not (_counters or _histograms):
+            return
+        try:
+            if not exists(METRICS_PATH):
+                makedirs(METRICS_PATH)
+            with open(METRICS_LOCK, 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                totals = _read()
+                for series, value in _counters.items():
+                    totals['counters'][series] = totals['counters'].get(series, 0) + value
+                for series, hist in _histograms.items():
+                    total = totals['histograms'].setdefault(series, {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0})
+                    total['buckets'] = [a + b for a, b in zip(total['buckets'], hist['buckets'])]
+                    total['sum'] += hist['sum']
+                    total['count'] += hist['count']
+                provfiles.write_json(METRICS_FILE, totals)
+        except OSError:
+            return # metrics must never break serving requests, keep them for the next attempt
+        _counters.clear()
+        _histograms.clear()
+
+def render(gauges={}):
+    """Totals (plus `gauges`, a dict of series to value) in Prometheus text format."""
+    flush()
+    totals = _read()
+    lines = []
+    for name, (kind, desc) in METRICS.items():
+        if kind == 'histogram':
+            series = {key: val for key,val in totals['histograms'].items() if key.split('{')[0] == name}
+        elif kind == 'counter':
+            series = {key: val for key,val in totals['counters'].items() if key.split('{')[0] == name}
+        else:
+            series = {key: val for key,val in gauges.items() if key.split('{')[0] == name}
+        if not series:
+            continue
+        lines.append("# HELP {} {}".format(name, desc))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for key, val in sorted(series.items()):
+            if kind != 'histogram':
+                lines.append("{} {}".format(key, val))
+                continue
+            labels = key[len(name):].strip('{}')
+            labels = labels + ',' if labels else ''
+            for bound, count in zip(BUCKETS, val['buckets']):
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, count))
+            lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, labels, val['count']))
+            lines.append("{}_sum{} {}".format(name, key[len(name):], val['sum']))
+            lines.append("{}_count{} {}".format(name, key[len(name):], val['count']))
+    return '\n'.join(lines) + '\n'
@@ -3,23 +3,55 @@
 import sys
 sys.path.append('/usr/local/share/micropython')
 
-from os import listdir, makedirs, remove
+from os import listdir, makedirs, remove, rename, stat, environ
 #from os.path import exists, isdir, isfile, getsize, basename, splitext, dirname, realpath
 from os.path import exists, isdir, isfile, getsize, basename, dirname
 from hashlib import sha256
 #from difflib import unified_diff
-import sqlite3
-import tarfile
-import random
-import string
-from sys import stderr
+from time import time, perf_counter, sleep
+import io
+import re
 import json
-import logging
+import provmetrics
+import provfiles
 
-logging.basicConfig(level=logging.DEBUG)
-log = logging.getLogger(__name__)
+class _LazyModule():
+    def __init__(self, name):
+        self._name = name
 
-PREFIX = '/PROV'
+    def __getattr__(self, attr):
+        return getattr(__import__(self._name), attr)
+
+def lazy_import(name):
+    """Stands in for module `name`, which is only imported once any of its
+    attributes is accessed. Every CGI request starts a new interpreter, most of
+    them only needing a fraction of the modules used here (e.g. `getHash`
+    never touches the database)."""
+    return _LazyModule(name)
+
+sqlite3 = lazy_import('sqlite3')
+tarfile = lazy_import('tarfile')
+gzip = lazy_import('gzip')
+shutil = lazy_import('shutil')
+random = lazy_import('random')
+logging = lazy_import('logging')
+
+LOG_LEVEL = environ.get('YAPS_LOG_LEVEL', 'INFO').upper()
+
+class _Log():
+    """Stands in for the logger until something actually gets logged."""
+    def __getattr__(self, name):
+        global log
+        logging.basicConfig(level=LOG_LEVEL)
+        log = logging.getLogger(__name__)
+        return getattr(log, name)
+
+log = _Log()
+
+# values bound to queries (including blobs) are only logged if explicitly enabled
+LOG_VALUES = environ.get('YAPS_LOG_VALUES') == '1'
+
+PREFIX = environ.get('YAPS_PREFIX', '/PROV')
 
 PROVCFG = "config.json"
 SECRET  = "secret"
@@ -29,6 +61,20 @@ LOCAL_PATH              = PREFIX + '/PROV/'
 LOCAL_PATH_PROVCFG      = LOCAL_PATH + PROVCFG
 LOCAL_PATH_DB           = LOCAL_PATH + "sets.db"
 LOCAL_PATH_SECRET       = LOCAL_PATH + SECRET
+LOCAL_PATH_STATIC       = LOCAL_PATH + "static.json" # digests of static files, see `index_static_files()`
+
+# Static files and the config are served gzip-compressed to devices accepting
+# it, compressed once by `index_static_files()` rather than per request and
+# stored next to them (`<name>.gz`, `config.json.gz` and `config.json.min.gz`
+# for the config as served, see `get_config_body()`).
+GZIP_SUFFIX             = ".gz"
+GZIP_LEVEL              = 9
+
+# Further projects can be served at the same time from stores next to the one
+# above (the default store), each a directory - or drive - of its own, laid out
+# just like LOCAL_PATH, see `get_stores()`.
+STORE_PATH              = PREFIX + '/PROV-{}/'
+STORE_NAME              = re.compile(r'^[A-Za-z0-9_-]+$')
 
 IN_PATH             = PREFIX + "/IMPORT/"
 #IN_PATH_SETS        = IN_PATH + "sets/" # trailing slash required!
@@ -38,41 +84,264 @@ IN_PATH             = PREFIX + "/IMPORT/"
 
 OUT_PATH            = PREFIX + "/EXPORT/"
 
+# volatile storage (tmpfs) for caching state across processes
+CACHE_PATH          = environ.get('YAPS_CACHE', '/tmp/yaps-cache/')
+CACHE_PATH_LOCAL    = CACHE_PATH + "local.json"
+CACHE_PATH_STORE    = CACHE_PATH + "local-{}.json"
+# manifests of the batches on the IMPORT drive (shared by all stores), see `scan_batch()`
+CACHE_PATH_BATCHES  = CACHE_PATH + "manifests.json"
+
+# meta data columns every set has, in contrast to the dynamic files (according
+# to `config.json`), which are stored in the table `files`, see `migrate_files()`
+FACTORY_SET_FIELDS = {
+    'id': ('TEXT', 'PRIMARY KEY', 'UNIQUE', 'NOT NULL'),
+    'batch': ('TEXT', 'NOT NULL'),
+    'imported_dt': ('DATETIME', 'DEFAULT CURRENT_TIMESTAMP'),
+    'downloaded_cnt': ('INTEGER', 'DEFAULT 0'),
+    'downloaded_dt': ('DATETIME',),
+    'dev_id': ('TEXT', 'UNIQUE'),
+    'prod_id': ('TEXT',),
+    'fw_ver': ('TEXT',),
+    'comment': ('TEXT',),
+}
+
+def migrate_files(system):
+    """Move dynamic files out of `sets` (where they used to be columns, each
+    with a unique index over the whole content) into `files`, a row per file.
+    Uniqueness is enforced via the sha256 digest of the content instead, and
+    `sets` - being scanned by most queries - only keeps the meta data.
+    Files never change once imported, `imported_seq` is the change sequence
+    number (see `get_version()`) they were imported with."""
+    system.sql.execute("CREATE TABLE `files` (`set_id` TEXT NOT NULL, `name` TEXT NOT NULL, `imported_seq` INTEGER NOT NULL, `digest` BLOB NOT NULL, `content` BLOB NOT NULL)", commit = False)
+    system.sql.execute("CREATE UNIQUE INDEX `files_set` ON `files` (`set_id`, `name`)", commit = False)
+    system.sql.execute("CREATE UNIQUE INDEX `files_digest` ON `files` (`name`, `digest`)", commit = False)
+    system.sql.execute("CREATE INDEX `files_imported` ON `files` (`imported_seq`)", commit = False)
+
+    system.sql.execute("PRAGMA table_info(`sets`)", commit = False)
+    columns = [column['name'] for column in system.sql.fetchall()]
+    if set(columns) <= set(FACTORY_SET_FIELDS) | {'modified_seq'}:
+        return # created by `initialize_db()` without them, possibly before the config is known
+    dyn_files = [dyn_file for dyn_file in system.get_dynamic_files() if dyn_file in columns]
+    if not dyn_files:
+        return
+    system.sql.sql_conn.create_function('sha256', 1, lambda content: sha256(content).digest(), deterministic=True)
+    for dyn_file in dyn_files:
+        system.sql.execute("INSERT INTO `files` (`set_id`, `name`, `imported_seq`, `digest`, `content`) SELECT `id`, ?, `modified_seq`, sha256(`{0}`), `{0}` FROM `sets`".format(dyn_file), (dyn_file,), commit = False)
+
+    # sqlite can't drop columns having a unique index, so the table is rebuilt
+    # (keeping rowids, hence the order sets are handed out in)
+    system.sql.execute("SELECT `sql` FROM `sqlite_master` WHERE `tbl_name` = 'sets' AND `type` IN ('index', 'trigger') AND `sql` IS NOT NULL", commit = False)
+    dependents = [row['sql'] for row in system.sql.fetchall()]
+    kept = ', '.join('`{}`'.format(column) for column in columns if column not in dyn_files)
+    system.sql.execute("CREATE TABLE `sets_narrow` ( {}, `modified_seq` INTEGER NOT NULL DEFAULT 0 )".format(
+        ', '.join('"{}" {}'.format(col, ' '.join(prop)) for col,prop in FACTORY_SET_FIELDS.items())
+    ), commit = False)
+    system.sql.execute("INSERT INTO `sets_narrow` (`rowid`, {0}) SELECT `rowid`, {0} FROM `sets`".format(kept), commit = False)
+    system.sql.execute("DROP TABLE `sets`", commit = False)
+    system.sql.execute("ALTER TABLE `sets_narrow` RENAME TO `sets`", commit = False)
+    for statement in dependents:
+        system.sql.execute(statement, commit = False)
+
+# Schema changes to `sets.db` after its creation by `initialize_db()`.
+# Entry N holds the statements migrating from schema version N to N+1 - or a
+# function doing so, for changes depending on `config.json` -, the version a
+# database is at is tracked via `PRAGMA user_version`, see `migrate_db()`.
+DB_MIGRATIONS = [
+    # free list for `allocate_set()`: partial index on unassigned sets only,
+    # ordered by rowid, hence handing out sets in the order they were imported
+    ("CREATE INDEX IF NOT EXISTS `sets_free` ON `sets` (`dev_id`) WHERE `dev_id` IS NULL",),
+    # change tracking for `get_sets(since=..)`: every modification of a set
+    # bumps the global sequence `sets_seq` and tags the set with its new value
+    (
+        "CREATE TABLE `sets_seq` (`value` INTEGER NOT NULL)",
+        "INSERT INTO `sets_seq` (`value`) VALUES (0)",
+        "ALTER TABLE `sets` ADD COLUMN `modified_seq` INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX `sets_modified` ON `sets` (`modified_seq`)",
+        "CREATE INDEX `sets_incomplete` ON `sets` (`downloaded_cnt`) WHERE `downloaded_cnt` < 0",
+        "CREATE TRIGGER `sets_modified` AFTER UPDATE OF `dev_id`, `prod_id`, `fw_ver`, `downloaded_cnt`, `downloaded_dt`, `comment` ON `sets` BEGIN "
+            "UPDATE `sets_seq` SET `value` = `value` + 1; "
+            "UPDATE `sets` SET `modified_seq` = (SELECT `value` FROM `sets_seq`) WHERE `rowid` = NEW.`rowid`; "
+        "END",
+    ),
+    # backups written from (or restored into) this database, incremental
+    # backups are based on the latest one of those, see `backup()`
+    ("CREATE TABLE `backups` (`file` TEXT NOT NULL, `version` INTEGER NOT NULL)",),
+    migrate_files,
+    # batches imported, so telling whether one already is doesn't take
+    # scanning all sets, see `is_batch_already_imported()`
+    (
+        "CREATE TABLE `imported_batches` (`batch` TEXT PRIMARY KEY NOT NULL, `sets` INTEGER NOT NULL, `imported_dt` DATETIME DEFAULT CURRENT_TIMESTAMP)",
+        "INSERT INTO `imported_batches` (`batch`, `sets`, `imported_dt`) SELECT `batch`, count(*), min(`imported_dt`) FROM `sets` GROUP BY `batch`",
+    ),
+]
+
+# tables contained in incremental backups along with the columns identifying
+# their rows, see `_restore_incremental()`
+INCREMENTAL_KEYS = {
+    'sets': ('id',),
+    'files': ('set_id', 'name'),
+    'imported_batches': ('batch',),
+}
+
+# meta data of sets as exported (see `export_sets()`), read EXPORT_PAGE at a time
+EXPORT_SET_FIELDS = ('id', 'batch', 'dev_id', 'prod_id', 'fw_ver', 'downloaded_cnt', 'downloaded_dt', 'comment')
+EXPORT_PAGE = 1000
+
+# set ID standing for "the next free set" when assigning in bulk, see `bulk_assign()`
+BULK_ANY = '*'
+
+# filters for listing sets by state, see `get_sets()`
+SET_STATES = {
+    'free': "`dev_id` IS NULL",
+    'assigned': "`dev_id` IS NOT NULL",
+    'incomplete': "`downloaded_cnt` < 0",
+    'complete': "`downloaded_cnt` > 0",
+}
+
+# Backups (see `backup()`) are named after the infrastructure they belong to
+# (a digest of `secret`) and the change sequence number (see `get_version()`)
+# they represent - incremental ones also the one of the backup they're based on.
+BACKUP_NAME = re.compile(r'^(?P<name>.+)\.(?P<tag>[0-9a-f]{8})\.(?P<kind>full|incr)\.v(?:(?P<since>\d+)-)?(?P<version>\d+)\.tgz$')
+BACKUP_MANIFEST = "backup.json"
+BACKUP_DB = "sets.db"
+BACKUP_PAGES = 256 # database pages copied per step, locks are released in between
+BACKUP_RESTARTS = 3 # copying in steps starts over on writes meanwhile, so give up on it after that many times
+
+# Concurrent access to `sets.db` by many devices at once: with a write-ahead
+# log readers don't block the writer (and vice versa), writers wait up to
+# BUSY_TIMEOUT seconds for each other, and writes of the device API are retried
+# BUSY_RETRIES times with exponential backoff beyond that, see `execute_retry()`.
+JOURNAL_MODE = environ.get('YAPS_JOURNAL_MODE', 'WAL')
+BUSY_TIMEOUT = float(environ.get('YAPS_BUSY_TIMEOUT', 5))
+BUSY_RETRIES = 3
+BUSY_BACKOFF = 0.05 # seconds, doubled with every retry
+
 INODES_IGNORE = ['lost+found'] # TODO: add other system specific inodes, e.g. i remember macosx has quite a few of those being created automatically
 
-try:
-    os_info = {}
-    with open("/etc/os-release") as f:
-        for line in f:
-            k,v = line.rstrip().split("=", 1)
-            os_info[k] = v.strip('"').strip("'")
-except:
-    log.error("Can't determine OS", file=stderr)
-    os_info['NAME'] = os_info['ID'] = os_info['VERSION'] = os_info['VERSION_ID'] = 'UNKNOWN'
+_os_info = None
 
+def get_os_info():
+    """Contents of `/etc/os-release`, read on first use only."""
+    global _os_info
+    if _os_info is None:
+        _os_info = {}
+        try:
+            with open("/etc/os-release") as f:
+                for line in f:
+                    if '=' in line:
+                        k,v = line.rstrip().split("=", 1)
+                        _os_info[k] = v.strip('"').strip("'")
+        except OSError:
+            log.error("Can't determine OS")
+        for k in ('NAME', 'ID', 'VERSION', 'VERSION_ID'):
+            _os_info.setdefault(k, 'UNKNOWN')
+    return _os_info
+
+
+# table a query is accounted to (see `SQLConn._label()`), per statement - others,
+# like DDL, aren't accounted to any; names may be qualified by the database
+_TABLE = r'(?:`?\w+`?\.)?`?(\w+)'
+QUERY_TABLE = {
+    'SELECT': re.compile(r'\bFROM\s+' + _TABLE, re.I),
+    'DELETE': re.compile(r'^\s*DELETE\s+FROM\s+' + _TABLE, re.I),
+    'INSERT': re.compile(r'^\s*INSERT\s+(?:OR\s+\w+\s+)?INTO\s+' + _TABLE, re.I),
+    'REPLACE': re.compile(r'^\s*REPLACE\s+INTO\s+' + _TABLE, re.I),
+    'UPDATE': re.compile(r'^\s*UPDATE\s+(?:OR\s+\w+\s+)?' + _TABLE, re.I),
+}
 
 class SQLConn:
-    def __init__(self):
+    def __init__(self, path=LOCAL_PATH_DB):
+        self.path = path
         self.sql_conn = None
         self.connected = False
+        self.label = None # of the last query, rows fetched are accounted to
 
     def connect(self):
-        self.sql_conn = sqlite3.connect(LOCAL_PATH_DB)
+        # sqlite creates the file if it doesn't exist, which then still counts
+        # as uninitialized as long as it's empty, see `check_db_file()`
+        initialized = isfile(self.path) and getsize(self.path) > 0
+        # `check_same_thread` disabled for `provd`, which serializes access itself
+        self.sql_conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
         self.sql_conn.isolation_level = None
         self.sql_conn.row_factory = sqlite3.Row
         self.sql_cur = self.sql_conn.cursor()
         self.connected = True
+        if initialized:
+            self.set_journal_mode()
+
+    def set_journal_mode(self):
+        # persistent, so it's only switched once (or back, if JOURNAL_MODE changed)
+        try:
+            self.execute("PRAGMA journal_mode")
+            if self.fetchone()[0].upper() != JOURNAL_MODE.upper():
+                self.execute("PRAGMA journal_mode = {}".format(JOURNAL_MODE))
+        except sqlite3.OperationalError as exc:
+            # switching requires no other connection being active, next one will do
+            log.warning("Can't switch journal mode to {}: {}".format(JOURNAL_MODE, exc))
+
+    def _label(self, query):
+        # statement and table, keeping the number of distinct metrics small
+        statement = re.match(r'\s*(\w*)', query).group(1).upper()
+        table = statement in QUERY_TABLE and QUERY_TABLE[statement].search(query)
+        return statement, table.group(1) if table else ''
+
+    def _account(self, query, values, start):
+        duration = perf_counter() - start
+        self.label = self._label(query)
+        provmetrics.observe('yaps_query_seconds', duration, statement=self.label[0], table=self.label[1])
+        if self.sql_cur.rowcount > 0:
+            provmetrics.inc('yaps_query_rows_total', self.sql_cur.rowcount, statement=self.label[0], table=self.label[1])
+        provmetrics.slow_query(duration, query, values if LOG_VALUES else "({} values)".format(len(values)))
 
     def execute(self, query, values = (), commit = True):
         if not self.connected:
             self.connect()
-        log.debug("SQL query to be executed (query/values): {} / {}".format(query, values))
+        if LOG_LEVEL == 'DEBUG':
+            log.debug("SQL query to be executed (query/values): {} / {}".format(query, values if LOG_VALUES else "({} values)".format(len(values))))
+        start = perf_counter()
         self.sql_cur.execute(query, values)
+        self._account(query, values, start)
+        if commit:
+            self.sql_conn.commit()
+
+    def executemany(self, query, values, commit = True):
+        # `values` might as well be a generator, consumed row by row
+        if not self.connected:
+            self.connect()
+        if LOG_LEVEL == 'DEBUG':
+            log.debug("SQL query to be executed for many rows: {}".format(query))
+        start = perf_counter()
+        self.sql_cur.executemany(query, values)
+        self._account(query, (), start)
         if commit:
             self.sql_conn.commit()
 
-    def begin(self):
-        self.sql_cur.execute("BEGIN")
+    def _retry(self, func, *args):
+        for attempt in range(BUSY_RETRIES + 1):
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as exc:
+                if 'locked' not in str(exc) and 'busy' not in str(exc):
+                    raise
+                provmetrics.inc('yaps_query_retries_total')
+                if attempt == BUSY_RETRIES:
+                    raise Busy("Database busy, try again later ({})".format(exc))
+                sleep(BUSY_BACKOFF * 2 ** attempt * (1 + random.random()))
+
+    def execute_retry(self, query, values = ()):
+        """`execute()`, retried with exponential backoff in case the database
+        is still locked after BUSY_TIMEOUT - raising `Busy` if it remains so."""
+        return self._retry(self.execute, query, values)
+
+    def begin(self, immediate=False, retry=False):
+        # `immediate` takes the write lock right away (waiting up to BUSY_TIMEOUT),
+        # rather than failing when upgrading to it after having read meanwhile;
+        # given `retry`, waiting is retried just like `execute_retry()` does
+        if not self.connected:
+            self.connect()
+        if retry:
+            return self._retry(self.sql_cur.execute, "BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self.sql_cur.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
 
     def rollback(self):
         self.sql_cur.execute("ROLLBACK")
@@ -81,14 +350,54 @@ class SQLConn:
         self.sql_cur.execute("COMMIT")
 
     def fetchone(self):
-        return self.sql_cur.fetchone()
+        row = self.sql_cur.fetchone()
+        if row is not None and self.label:
+            provmetrics.inc('yaps_query_rows_total', statement=self.label[0], table=self.label[1])
+        return row
 
     def fetchall(self):
-        return self.sql_cur.fetchall()
+        rows = self.sql_cur.fetchall()
+        if rows and self.label:
+            provmetrics.inc('yaps_query_rows_total', len(rows), statement=self.label[0], table=self.label[1])
+        return rows
 
     def rows_affected(self):
         return self.sql_cur.rowcount
 
+    def backup(self, path, progress=None):
+        """Consistent copy of the database to `path` via sqlite's online
+        backup API, copied in steps of BACKUP_PAGES, so concurrent writers only
+        get blocked for a step at a time rather than for the whole copy.
+        As a write by another connection makes the copy start over, it's done
+        in a single step after BACKUP_RESTARTS of those.
+        `progress` - if given - gets called with (remaining, total) pages."""
+        if not self.connected:
+            self.connect()
+        state = {'remaining': None, 'restarts': 0}
+        def _progress(status, remaining, total):
+            if state['remaining'] is not None and remaining > state['remaining']:
+                state['restarts'] += 1
+                if state['restarts'] >= BACKUP_RESTARTS:
+                    raise StopIteration # aborts the backup
+            state['remaining'] = remaining
+            progress and progress(remaining, total)
+
+        target = sqlite3.connect(path)
+        try:
+            try:
+                self.sql_conn.backup(target, pages=BACKUP_PAGES, progress=_progress)
+            except StopIteration:
+                log.info("Database modified while being copied, copying it at once")
+                self.sql_conn.backup(target)
+                progress and progress(0, state['remaining'] or 0)
+        finally:
+            target.close()
+
+    def close(self):
+        if self.connected:
+            self.sql_conn.close()
+            self.connected = False
+
     def __del__(self):
         try:
             self.sql_conn.close()
@@ -120,14 +429,61 @@ class Uninitialized(ProvSysError):
 class NoFree(ProvSysError):
     """all sets are in use"""
 
+class NotAssigned(ProvSysError):
+    """no set assigned to device (yet)"""
+
+class Busy(ProvSysError):
+    """database kept being locked by others"""
+
+class NoSuchStore(ProvSysError):
+    """project store requested isn't available"""
+
+
+def get_stores():
+    """Names of the project stores available besides the default one."""
+    try:
+        return sorted(elem[len('PROV-'):] for elem in listdir(PREFIX) if elem.startswith('PROV-') and STORE_NAME.match(elem[len('PROV-'):]) and isdir("{}/{}".format(PREFIX, elem)))
+    except OSError:
+        return []
+
+def select_store(project=None, prod_id=None):
+    """Store to provision a device from: the one of `project` if requested
+    explicitly, otherwise the one named after the product (`prod_id`) if
+    there is such a store, falling back to the default store (`None`)."""
+    if project:
+        if not STORE_NAME.match(project) or not isdir(STORE_PATH.format(project)):
+            raise NoSuchStore("{}: no such project store".format(project))
+        return project
+    if prod_id and STORE_NAME.match(prod_id) and isdir(STORE_PATH.format(prod_id)):
+        return prod_id
+    return None
+
 
 class ProvSystem():
-    def __init__(self):
+    def __init__(self, store=None):
+        # `store` selects one of the project stores (see `get_stores()`), each
+        # having its own config, secret, database and cached state
+        self.store = store
+        if store is None:
+            self.local_path = LOCAL_PATH
+            self.cache_path_local = CACHE_PATH_LOCAL
+        else:
+            if not STORE_NAME.match(store) or not isdir(STORE_PATH.format(store)):
+                raise NoSuchStore("{}: no such project store".format(store))
+            self.local_path = STORE_PATH.format(store)
+            self.cache_path_local = CACHE_PATH_STORE.format(store)
+        self.local_path_provcfg = self.local_path + PROVCFG
+        self.local_path_db = self.local_path + "sets.db"
+        self.local_path_secret = self.local_path + SECRET
+        self.local_path_static = self.local_path + "static.json"
         # as we'd like to create an SQL connection right at the beginning globally, we need to ensure the directory the sqlite file is stored in is setup before. this is redundant and ugly.
-        if not exists(LOCAL_PATH):
-            makedirs(LOCAL_PATH)
-        self.sql = SQLConn()
+        if not exists(self.local_path):
+            makedirs(self.local_path)
+        self.sql = SQLConn(self.local_path_db)
         self.cfg = {}
+        self.files = {} # cache for local files not expected to change while we're running, see `read_local_file()`
+        self.validated = None # last result of the consistency check, see `check_consistency_local()`
+        self.static_index = None # see `get_static_file_info()`
 
         #if not exists(LOCAL_PATH_IMPORTED):
         #    with open(LOCAL_PATH_IMPORTED, "w") as f: f.write("")
@@ -135,8 +491,44 @@ class ProvSystem():
     def read_file(self, path, binary = False):
         return open("%s" % (path), binary and "rb" or "r").read()
 
+    def read_local_file(self, name):
+        """Like `read_file()` for files of the store, but keeping their content
+        in memory. Callers holding on to a `ProvSystem` for longer (see `provd`)
+        need to drop it once `fingerprint()` changes."""
+        if name not in self.files:
+            self.files[name] = self.read_file(self.local_path + name, binary=True)
+        return self.files[name]
+
+    def get_secret(self):
+        return self.read_local_file(SECRET)
+
+    def fingerprint(self):
+        """Cheap summary of the state of the store, changing whenever the
+        config, secret or static files are altered or the drive gets swapped.
+        For the database only device and inode are taken into account, as its
+        mtime changes with every allocation - it only gets replaced on
+        (re)initialization."""
+        def _stat(path, full=True):
+            try:
+                st = stat(path)
+            except OSError:
+                return None
+            return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size) if full else (st.st_dev, st.st_ino)
+
+        try:
+            static_files = self.get_static_files()
+        except (KeyError, TypeError, AttributeError):
+            static_files = []
+        return (
+            _stat(self.local_path, full=False), # its mtime changes with every journal created by sqlite
+            _stat(self.local_path_provcfg),
+            _stat(self.local_path_secret),
+            _stat(self.local_path_db, full=False),
+            tuple(_stat(self.local_path + static_file) for static_file in static_files),
+        )
+
     def parse_config(self):
-        self.cfg = json.load(open(LOCAL_PATH_PROVCFG, 'r'))
+        self.cfg = json.load(open(self.local_path_provcfg, 'r'))
 
     def get_batches(self, check_for_imported=True):
         """Get all batches, meaning, everything which *might* be one.
@@ -148,10 +540,119 @@ class ProvSystem():
 
         #return [elem for elem in listdir(IN_PATH) if (isdir("%s%s" % (IN_PATH, elem))) and (elem != "KEEP")]
         #return [{'name': (elem for elem in listdir(IN_PATH) if elem != "KEEP"), 'imported': False}]
-        return [{'name': elem, 'imported': self.is_batch_already_imported(elem) if check_for_imported else None} for elem in listdir(IN_PATH) if not elem in INODES_IGNORE]
+        batches = [elem for elem in listdir(IN_PATH) if not elem in INODES_IGNORE]
+        if not check_for_imported:
+            return [{'name': elem, 'imported': None} for elem in batches]
+        # Along with what's known about them from having been scanned before
+        # (see `scan_batch()`), listing never reads the archives themselves -
+        # `scanned` tells which ones still need to be.
+        imported = self.get_imported_batches()
+        digest = self.initialized() and self._config_digest(self.cfg)
+        manifests = self._read_batch_manifests()
+        res = []
+        for elem in batches:
+            if elem in imported:
+                res.append({'name': elem, 'imported': True, 'scanned': True, 'sets': imported[elem], 'compatible': True})
+                continue
+            manifest = self._fresh_batch_manifest(elem, manifests)
+            res.append({
+                'name': elem,
+                'imported': False,
+                'scanned': manifest is not None,
+                'sets': manifest['sets'] if manifest and not manifest['error'] else None,
+                'compatible': None if not manifest or not digest else manifest['config'] == digest,
+            })
+        return res
+
+    def _config_digest(self, cfg):
+        # configs compare equal the way `diff_cfg()` does
+        return sha256(json.dumps(cfg, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _read_batch_manifests(self):
+        try:
+            with open(CACHE_PATH_BATCHES, 'r') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def _fresh_batch_manifest(self, batch, manifests):
+        try:
+            st = stat(IN_PATH + batch)
+        except OSError:
+            return None
+        manifest = manifests.get(batch)
+        if not manifest or (manifest['size'], manifest['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+            return None
+        return manifest
+
+    def scan_batch(self, batch, strict=False):
+        """Manifest of archive `batch`: number of members and sets and digest
+        of the config it contains - or an `error` telling why it's not a stage2
+        provisioning import archive at all.
+        Archives are only read once, manifests are kept (CACHE_PATH_BATCHES)
+        keyed by name, size and mtime of the archive - being read by every
+        listing, they only hold counts, not the sets themselves.
+        Given `strict`, failing to keep the manifest raises rather than being
+        logged only."""
+        manifest = self._fresh_batch_manifest(batch, self._read_batch_manifests())
+        if manifest:
+            return manifest
+        st = stat(IN_PATH + batch)
+        manifest = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'members': 0, 'sets': 0, 'config': None, 'error': None}
+        sets = False
+        set_id = None
+        try:
+            with tarfile.open(IN_PATH + batch, 'r|*') as tar_fd:
+                for member in tar_fd:
+                    tar_fd.members = [] # see `_stream_batch()`
+                    manifest['members'] += 1
+                    name = member.name[2:] if member.name.startswith('./') else member.name
+                    path = name.split('/')
+                    if name == PROVCFG and member.isfile():
+                        manifest['config'] = self._config_digest(json.loads(tar_fd.extractfile(member).read().decode('utf-8')))
+                    elif path[0] == 'sets':
+                        sets = True
+                        # files of a set are next to each other, see `_stream_batch()`
+                        if len(path) > 1 and path[1] and path[1] != set_id:
+                            set_id = path[1]
+                            manifest['sets'] += 1
+            if not manifest['config'] or not sets:
+                raise ValueError("lacks {} or sets".format(PROVCFG))
+        except (tarfile.TarError, EOFError, OSError, ValueError) as exc:
+            manifest['error'] = str(exc)
+
+        # manifests of archives gone from the drive are dropped
+        manifests = {name: elem for name, elem in self._read_batch_manifests().items() if exists(IN_PATH + name)}
+        manifests[batch] = manifest
+        try:
+            provfiles.write_json(CACHE_PATH_BATCHES, manifests)
+        except OSError as exc:
+            if strict:
+                raise ProvSysError("{}: Can't cache manifest of batch ({})".format(batch, exc))
+            log.warning("Can't cache manifest of batch: {}".format(exc))
+        return manifest
 
     def get_backups(self):
-        return [elem for elem in listdir(OUT_PATH) if elem not in INODES_IGNORE]
+        # leading dot: backup currently being written, see `backup()`
+        return [elem for elem in listdir(OUT_PATH) if elem not in INODES_IGNORE and not elem.startswith('.')]
+
+    def parse_backup_name(self, name):
+        """Properties of backup `name` encoded in its name, see BACKUP_NAME.
+        `None` for anything else (e.g. backups of earlier versions, being a plain
+        archive of LOCAL_PATH)."""
+        match = BACKUP_NAME.match(name)
+        if not match:
+            return None
+        res = match.groupdict()
+        res['file'] = name
+        res['since'] = int(res['since']) if res['since'] else None
+        res['version'] = int(res['version'])
+        return res
+
+    def get_backup_tag(self):
+        # distinguishes infrastructures, so backups of different ones sharing
+        # an EXPORT drive don't get mixed up
+        return sha256(self.get_secret()).hexdigest()[:8]
 
     def _non_empty_dir(self, path, exc_cls = Exception):
         if not (isdir(path) and len(listdir(path))):
@@ -191,11 +692,10 @@ class ProvSystem():
 
     def check_consistency_incoming_batch(self, batch):
         try:
-            tar_fd = tarfile.open(IN_PATH + batch, 'r')
-            tar_members = [ mem.strip('./') for mem in tar_fd.getnames() ]
-            assert(PROVCFG in tar_members)
-            assert("sets" in tar_members)
-        except:
+            manifest = self.scan_batch(batch)
+        except OSError:
+            manifest = None
+        if not manifest or manifest['error']:
             raise IncomingIntegrityError("{}: expected it being a stage2 provisioning import archive".format(IN_PATH + batch))
 
         # although this method would throw an exception if it fails, we still
@@ -217,42 +717,95 @@ class ProvSystem():
         # `check_X() or False` work (as `None` -> `False`).
         return True
 
-    def check_consistency_local(self):
+    def check_consistency_local(self, force=False):
+        """Whether the system is initialized (and consistent, raising if not).
+        As this is called for pretty much every request, results are cached
+        keyed by `fingerprint()` - within this instance as well as across
+        processes (CACHE_PATH_LOCAL, per store) - so the full check only runs after
+        something changed on the PROV drive, or if `force`d."""
+        if not force:
+            res = self._cached_consistency_local()
+            if res is not None:
+                return res
+        res = self._check_consistency_local()
+        self._cache_consistency_local(res)
+        return res
+
+    def _cached_consistency_local(self):
+        if self.validated is None:
+            try:
+                with open(self.cache_path_local, 'r') as fd:
+                    cache = json.load(fd)
+            except (OSError, ValueError):
+                return None
+            # schema version is part of the key, so pending migrations get applied
+            if cache.get('path') != self.local_path or cache.get('schema') != len(DB_MIGRATIONS):
+                return None
+            self.validated = cache
+        # static files to take into account are determined by the config
+        # the cached result was based on
+        cfg = self.cfg
+        self.cfg = self.validated['cfg']
+        if json.dumps(self.fingerprint()) != self.validated['fingerprint']:
+            self.cfg = cfg
+            self.validated = None
+            return None
+        return self.validated['initialized']
+
+    def _cache_consistency_local(self, res):
+        self.validated = {
+            'path': self.local_path,
+            'schema': len(DB_MIGRATIONS),
+            'fingerprint': json.dumps(self.fingerprint()),
+            'cfg': self.cfg if res else {},
+            'initialized': res,
+        }
+        try:
+            provfiles.write_json(self.cache_path_local, self.validated)
+        except OSError as exc:
+            log.warning("Can't cache result of consistency check: {}".format(exc))
+
+    def _check_consistency_local(self):
 
         def check_config_exists():
             try:
-                self._non_empty_file(LOCAL_PATH_PROVCFG, ProvSysError)
+                self._non_empty_file(self.local_path_provcfg, ProvSysError)
             except:
-                return LocalIntegrityError("{}: expected it being a non-empty file".format(LOCAL_PATH_PROVCFG))
+                return LocalIntegrityError("{}: expected it being a non-empty file".format(self.local_path_provcfg))
 
         def check_config_parsable():
             try:
                 self.parse_config()
             except:
-                return LocalIntegrityError("{}: expected it being a JSON-parsable file".format(LOCAL_PATH_PROVCFG))
+                return LocalIntegrityError("{}: expected it being a JSON-parsable file".format(self.local_path_provcfg))
 
         def check_db_file():
             try:
-                self._non_empty_file(LOCAL_PATH_DB, ProvSysError)
+                self._non_empty_file(self.local_path_db, ProvSysError)
                 #TODO: read and parse sqlite file
             except:
-                return LocalIntegrityError("{}: expected it being a non-empty, sqlite database file".format(LOCAL_PATH_DB))
+                return LocalIntegrityError("{}: expected it being a non-empty, sqlite database file".format(self.local_path_db))
 
         def check_files_db():
             try:
                 self.sql.execute('PRAGMA table_info(sets)')
                 columns = [i[1] for i in self.sql.fetchall()]
-                dyn_files = self.get_dynamic_files()
-                for dyn_file in dyn_files:
-                    if not dyn_file in columns:
-                        raise LocalIntegrityError("{}: no such column in database".format(dyn_file))
+                if not columns:
+                    raise LocalIntegrityError("sets: no such table in database")
+                self.sql.execute("SELECT count(*) FROM `sqlite_master` WHERE `type` = 'table' AND `name` = 'files'")
+                if not self.sql.fetchone()[0]:
+                    # not yet migrated, see `migrate_files()`
+                    dyn_files = self.get_dynamic_files()
+                    for dyn_file in dyn_files:
+                        if not dyn_file in columns:
+                            raise LocalIntegrityError("{}: no such column in database".format(dyn_file))
             except Exception as exc:
                 return exc
 
         def check_files():
             try:
                 for static_file in self.get_static_files():
-                    self._non_empty_file("{}/{}".format(LOCAL_PATH, static_file), LocalIntegrityError)
+                    self._non_empty_file("{}/{}".format(self.local_path, static_file), LocalIntegrityError)
             except Exception as exc:
                 return exc
 
@@ -273,6 +826,7 @@ class ProvSystem():
 
         if all(not isinstance(_res, Exception) for _res in res):
             # all checks passed which means, system is initialized and consistent
+            self.migrate_db()
             return True
 
         # if not all items are exceptions and not all items are non-exceptions,
@@ -287,10 +841,9 @@ class ProvSystem():
         if not self.initialized():
             raise Uninitialized()
 
-        with tarfile.open(IN_PATH + batch) as tar_fd:
-            prfx = './' if '.' in tar_fd.getnames() else ''
-            if not self.diff_cfg(tar_fd.extractfile("{}{}".format(prfx, PROVCFG))):
-                raise IncomingIntegrityError("{} vs {}: To be imported provisioning config file incompatible to current one".format(LOCAL_PATH_PROVCFG, "{}|config.json".format(batch), LOCAL_PATH_PROVCFG))
+        self.check_consistency_incoming_batch(batch)
+        if self.scan_batch(batch)['config'] != self._config_digest(self.cfg):
+            raise IncomingIntegrityError("{} vs {}: To be imported provisioning config file incompatible to current one".format(self.local_path_provcfg, "{}|config.json".format(batch), self.local_path_provcfg))
 
         # although this method would throw an exception if it fails, we still
         # need to return True if it doesn't, to make logical constructs like
@@ -301,63 +854,431 @@ class ProvSystem():
         return json.dumps(self.cfg, sort_keys=True) == json.dumps(json.loads(fd_cfg_incoming.read().decode('utf-8')), sort_keys=True)
 
     def initialize_db(self):
-        factory_set_fields = {
-            'id': ('TEXT', 'PRIMARY KEY', 'UNIQUE', 'NOT NULL'),
-            'batch': ('TEXT', 'NOT NULL'),
-            'imported_dt': ('DATETIME', 'DEFAULT CURRENT_TIMESTAMP'),
-            'downloaded_cnt': ('INTEGER', 'DEFAULT 0'),
-            'downloaded_dt': ('DATETIME',),
-            'dev_id': ('TEXT', 'UNIQUE'),
-            'prod_id': ('TEXT',),
-            'fw_ver': ('TEXT',),
-            'comment': ('TEXT',),
-        }
-        dynamic_set_fields = { field: ('BINARY', 'UNIQUE', 'NOT NULL') for field in self.get_dynamic_files() }
-        log.debug("Fields to be created: {}".format([ tuple(factory_set_fields.items()) + tuple(dynamic_set_fields.items()) ]))
+        factory_set_fields = FACTORY_SET_FIELDS
+        log.debug("Fields to be created: {}".format(tuple(factory_set_fields.items())))
+        # dynamic files are added by the migrations, see `migrate_files()`
         self.sql.execute('CREATE TABLE `sets` ( {} )'.format(
-            ',\n'.join({ '"{}" {}'.format(col, ' '.join(prop)) for col,prop in {**factory_set_fields, **dynamic_set_fields}.items() })
-            #',\n'.join({ '"{}" {}'.format(col, ' '.join(prop)) for col,prop in dict([ tuple(factory_set_fields.items()) + tuple(dynamic_set_fields.items()) ]) })
+            ',\n'.join({ '"{}" {}'.format(col, ' '.join(prop)) for col,prop in factory_set_fields.items() })
         ))
-
-    def initialize(self, batch):
-        self.check_consistency_incoming_batch(batch)
-        if not exists(LOCAL_PATH):
-            makedirs(LOCAL_PATH)
-        with tarfile.open(IN_PATH + batch) as tar_fd:
-            prfx = './' if '.' in tar_fd.getnames() else ''
-            with open(LOCAL_PATH_PROVCFG, 'wb') as fd:
-                fd.write(tar_fd.extractfile(tar_fd.getmember("{}{}".format(prfx, PROVCFG))).read())
-            self.parse_config()
-            with open(LOCAL_PATH_SECRET, 'wb') as fd:
-                fd.write(tar_fd.extractfile(tar_fd.getmember("{}{}".format(prfx, SECRET))).read())
-            for _endpoint_key, _endpoint_val in self.cfg['endpoints'].items():
-                for static_file in self.get_static_files():
-                    try:
-                        member = tar_fd.getmember("{}{}".format(prfx, static_file))
-                    except:
-                        raise IncomingIntegrityError("File referenced in config but wasn't found in archive", "{}{}".format(prfx, static_file))
-                    with open("{}{}".format(LOCAL_PATH, static_file), 'wb') as fd:
-                        fd.write(tar_fd.extractfile(member).read())
-        self.initialize_db()
+        self.sql.set_journal_mode()
+        self.migrate_db()
+
+    def migrate_db(self):
+        """Bring an existing database up to the current schema version by
+        applying what's missing of `DB_MIGRATIONS`."""
+        self.sql.execute_retry("PRAGMA user_version")
+        if self.sql.fetchone()[0] >= len(DB_MIGRATIONS):
+            return
+        # concurrent requests after an upgrade all get here, only the first
+        # one holding the write lock migrates
+        self.sql.begin(immediate=True, retry=True)
+        try:
+            self.sql.execute("PRAGMA user_version", commit = False)
+            version = self.sql.fetchone()[0]
+            if version >= len(DB_MIGRATIONS):
+                self.sql.rollback()
+                return
+            for migration in DB_MIGRATIONS[version:]:
+                if callable(migration):
+                    migration(self)
+                    continue
+                for statement in migration:
+                    self.sql.execute(statement, commit = False)
+            self.sql.execute("PRAGMA user_version = {:d}".format(len(DB_MIGRATIONS)), commit = False)
+            self.sql.commit()
+        except:
+            self.sql.rollback()
+            raise
+        log.info("Migrated database from schema version {} to {}".format(version, len(DB_MIGRATIONS)))
+        if version <= DB_MIGRATIONS.index(migrate_files):
+            # give the space of the columns moved back to the filesystem
+            try:
+                self.sql.execute("VACUUM")
+            except sqlite3.OperationalError as exc:
+                log.warning("Can't vacuum database after migration: {}".format(exc))
+
+    def initialize(self, staged):
+        """Take config, secret and static files of the very first batch
+        imported into place, as staged by `_stream_batch()` (`staged` being
+        what it found), dropping anything else."""
+        required = [PROVCFG, SECRET] + self.get_static_files()
+        for local_file in required:
+            if local_file not in staged:
+                raise IncomingIntegrityError("File referenced in config but wasn't found in archive", local_file)
+        for local_file in staged:
+            if local_file in required:
+                rename(self._staged_path(local_file), self.local_path + local_file)
+            else:
+                remove(self._staged_path(local_file))
+        staged.clear()
+        self.index_static_files()
+
+    def _staged_path(self, name):
+        return "{}.{}.import".format(self.local_path, name)
+
+    def get_config_body(self, compact=False):
+        """The config as served to devices, pretty-printed or `compact`."""
+        if compact:
+            return json.dumps(self.cfg, separators=(',', ':'))
+        return json.dumps(self.cfg, indent=2, separators=(',', ': '))
+
+    def _gzip(self, chunks, name):
+        """Write `chunks` gzip-compressed to local file `name`, returning its
+        size - or `None` (removing it) if compressing doesn't pay off."""
+        path = self.local_path + name
+        # mgmt might be indexing at the same time as well
+        tmp = provfiles.tmp_path(path)
+        size = 0
+        try:
+            with open(tmp, 'wb') as fd:
+                # neither name nor time in the header, so unchanged content results in the same bytes
+                with gzip.GzipFile(filename='', mode='wb', fileobj=fd, compresslevel=GZIP_LEVEL, mtime=0) as gz_fd:
+                    for chunk in chunks:
+                        size += len(chunk)
+                        gz_fd.write(chunk)
+                compressed = fd.tell()
+            self.files.pop(name, None)
+            try:
+                if compressed < size:
+                    rename(tmp, path)
+                    return compressed
+                if exists(path):
+                    remove(path)
+            except OSError as exc:
+                log.warning("Can't store {}: {}".format(path, exc))
+            return None
+        finally:
+            try:
+                remove(tmp)
+            except OSError:
+                pass
+
+    def index_static_files(self):
+        """Precompute digest and size of all static files (for devices to
+        request them conditionally, see `provapi`) and store it next to them,
+        along with their compressed variants (see GZIP_SUFFIX)."""
+        index = {}
+        for static_file in self.get_static_files():
+            st = stat(self.local_path + static_file)
+            digest = sha256()
+            def chunks():
+                with open(self.local_path + static_file, 'rb') as fd:
+                    for chunk in iter(lambda: fd.read(65536), b''):
+                        digest.update(chunk)
+                        yield chunk
+            compressed = self._gzip(chunks(), static_file + GZIP_SUFFIX)
+            index[static_file] = {'sha256': digest.hexdigest(), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'gzip': compressed}
+        st = stat(self.local_path_provcfg)
+        index[PROVCFG] = {
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'gzip': self._gzip([self.get_config_body().encode('utf-8')], PROVCFG + GZIP_SUFFIX),
+            'gzip_compact': self._gzip([self.get_config_body(compact=True).encode('utf-8')], PROVCFG + ".min" + GZIP_SUFFIX),
+        }
+        try:
+            provfiles.write_json(self.local_path_static, index)
+        except OSError as exc:
+            log.warning("Can't write index of static files: {}".format(exc))
+        self.static_index = index
+
+    def _indexed(self, name):
+        # entry of `name` in the index, `None` if it changed since
+        if self.static_index is None:
+            try:
+                with open(self.local_path_static, 'r') as fd:
+                    self.static_index = json.load(fd)
+            except (OSError, ValueError):
+                self.static_index = {}
+        st = stat(self.local_path + name)
+        info = self.static_index.get(name)
+        if not info or 'gzip' not in info or (info['size'], info['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+            return None
+        return info
+
+    def static_index_stale(self):
+        """Whether any static file (or the config) changed since indexed by
+        `index_static_files()` - which happens on import and restore, but
+        not for files changed by hand or indexes of earlier versions."""
+        return any(self._indexed(name) is None for name in [PROVCFG] + self.get_static_files())
+
+    def get_static_file_info(self, name):
+        """Digest, size, path and size compressed (`None` if it isn't) of
+        static file `name` as precomputed by `index_static_files()`.
+        Devices never wait for (nor race each other) reindexing: a file
+        changed since is described as is and served uncompressed, until
+        mgmt reindexed (see `static_index_stale()`)."""
+        info = self._indexed(name)
+        if info is None:
+            st = stat(self.local_path + name)
+            digest = sha256()
+            with open(self.local_path + name, 'rb') as fd:
+                for chunk in iter(lambda: fd.read(65536), b''):
+                    digest.update(chunk)
+            info = {'sha256': digest.hexdigest(), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'gzip': None}
+        return dict(info, path=self.local_path + name)
+
+    def get_config_gzip(self, compact=False):
+        """The config as served (see `get_config_body()`) gzip-compressed,
+        `None` if compressing it doesn't pay off - or the config changed since
+        compressed, see `static_index_stale()`."""
+        info = self._indexed(PROVCFG)
+        if not info or not info['gzip_compact' if compact else 'gzip']:
+            return None
+        return self.read_local_file(PROVCFG + (".min" if compact else "") + GZIP_SUFFIX)
 
     def is_batch_already_imported(self, batch):
         if not self.initialized():
             return False
 
-        self.sql.execute("SELECT `batch` FROM `sets` GROUP BY `batch`")
-        set1 = self.sql.fetchall()
-        for elem in set1:
-            if batch in elem:
-                return True
-        return False
+        self.sql.execute("SELECT 1 FROM `imported_batches` WHERE `batch` = ?", (batch,))
+        return self.sql.fetchone() is not None
+
+    def get_imported_batches(self):
+        """Batches imported along with their number of sets."""
+        if not self.initialized():
+            return {}
+
+        self.sql.execute("SELECT `batch`, `sets` FROM `imported_batches`")
+        return {row['batch']: row['sets'] for row in self.sql.fetchall()}
 
     #def backup(self, name="PROV-BACKUP_%s" % (''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5)))):
-    def backup(self, name):
-        if not self.initialized:
-            raise Uninitiaized("Can not backup uninitialized system")
+    def backup(self, name, incremental=False, progress=None):
+        """Write a backup to OUT_PATH, named `name` plus what BACKUP_NAME
+        describes, which is returned.
+        The database is never read from its file directly, but snapshotted
+        while in use: a full backup copies it via sqlite's online backup API,
+        an incremental one (given `incremental` and a previous backup of this
+        infrastructure on the EXPORT drive) only contains sets changed since the
+        latest backup, read within a single transaction.
+        The snapshot is staged on the EXPORT drive and added to the archive
+        file by file, so memory usage doesn't depend on the number of sets.
+        `progress` - if given - gets called with the state of the snapshot (see
+        `import_batch()` for the keys)."""
+        if not self.initialized():
+            raise Uninitialized("Can not backup uninitialized system")
+
+        tag = self.get_backup_tag()
+        since = None
+        if incremental:
+            # the EXPORT drive might have been swapped or cleaned up meanwhile
+            available = self.get_backups()
+            self.sql.execute("SELECT `file`, `version` FROM `backups` ORDER BY `version`")
+            since = max((backup['version'] for backup in self.sql.fetchall() if backup['file'] in available), default=None)
+        snapshot = "{}.{}.db".format(OUT_PATH, name)
+        tmp = None
+        try:
+            remove(snapshot) # leftover of a backup interrupted before
+        except OSError:
+            pass
+        try:
+            if since is None:
+                version = self._snapshot_full(snapshot, progress)
+                res = "{}.{}.full.v{}.tgz".format(name, tag, version)
+            else:
+                version = self._snapshot_incremental(snapshot, since)
+                res = "{}.{}.incr.v{}-{}.tgz".format(name, tag, since, version)
+            manifest = bytes(json.dumps({
+                'project': self.get_project_name(),
+                'tag': tag,
+                'kind': 'full' if since is None else 'incr',
+                'since': since,
+                'version': version,
+                'schema': len(DB_MIGRATIONS),
+                'created': time(),
+            }), 'utf-8')
+            tmp = "{}.{}".format(OUT_PATH, res)
+            with tarfile.open(tmp, 'w:gz') as tar_fd:
+                info = tarfile.TarInfo(BACKUP_MANIFEST)
+                info.size = len(manifest)
+                info.mtime = time()
+                tar_fd.addfile(info, io.BytesIO(manifest))
+                if since is None:
+                    for local_file in [PROVCFG, SECRET] + self.get_static_files():
+                        tar_fd.add(self.local_path + local_file, arcname=local_file)
+                tar_fd.add(snapshot, arcname=BACKUP_DB)
+            rename(tmp, OUT_PATH + res)
+            self.sql.execute("INSERT INTO `backups` (`file`, `version`) VALUES (?, ?)", (res, version))
+        finally:
+            for path in (snapshot, tmp):
+                try:
+                    path and remove(path)
+                except OSError:
+                    pass
+        log.info("Backup {} written".format(res))
+        return res
+
+    def _snapshot_full(self, path, progress=None):
+        state = {'processed': 0}
+        def _progress(remaining, total):
+            state['processed'] = state['position'] = total - remaining
+            state['size'] = total
+            progress and progress(state)
+        self.sql.backup(path, _progress)
+        snapshot = sqlite3.connect(path)
+        try:
+            return snapshot.execute("SELECT `value` FROM `sets_seq`").fetchone()[0]
+        finally:
+            snapshot.close()
 
-        with tarfile.open(OUT_PATH + name, 'w:gz') as tar_fd:
-            tar_fd.add(LOCAL_PATH)
+    def _snapshot_incremental(self, path, since):
+        self.sql.execute("ATTACH DATABASE ? AS `incremental`", (path,))
+        try:
+            self.sql.begin()
+            try:
+                version = self.get_version()
+                # rowids are kept, as they decide the order sets are handed out in
+                self.sql.execute("CREATE TABLE `incremental`.`sets` AS SELECT `rowid` AS `_rowid`, * FROM `main`.`sets` WHERE `modified_seq` > ?", (since,), commit = False)
+                # files don't change once imported, so only the ones of new sets
+                self.sql.execute("CREATE TABLE `incremental`.`files` AS SELECT * FROM `main`.`files` WHERE `imported_seq` > ?", (since,), commit = False)
+                # along with the (short) list of all batches imported
+                self.sql.execute("CREATE TABLE `incremental`.`imported_batches` AS SELECT * FROM `main`.`imported_batches`", commit = False)
+                self.sql.commit()
+            except:
+                self.sql.rollback()
+                raise
+        finally:
+            self.sql.execute("DETACH DATABASE `incremental`")
+        return version
+
+    def get_backup_chain(self, name):
+        """Backups to be restored one after another in order to restore backup
+        `name`: the full backup it is based on, followed by the incremental
+        ones leading up to it."""
+        target = self.parse_backup_name(name)
+        if not target:
+            raise IncomingIntegrityError("{}: not a backup which can be restored".format(name))
+        # incremental backups without any changes (`since` == `version`) can't
+        # serve as base, as they'd lead to themselves
+        backups = [backup for backup in map(self.parse_backup_name, self.get_backups()) if backup and backup['tag'] == target['tag'] and (backup['kind'] == 'full' or backup['since'] < backup['version'])]
+        chain = [target]
+        while chain[0]['kind'] == 'incr':
+            base = [backup for backup in backups if backup['version'] == chain[0]['since']]
+            if not base:
+                raise IncomingIntegrityError("{}: backup it is based on (version {}) is missing".format(chain[0]['file'], chain[0]['since']), name)
+            # prefer a full backup over an incremental one of the same version
+            chain.insert(0, min(base, key=lambda backup: backup['kind'] != 'full'))
+        return [backup['file'] for backup in chain]
+
+    def restore(self, name, progress=None):
+        """Replace the local state by backup `name` (see `backup()`), which
+        must be one of this infrastructure unless the system isn't initialized.
+        Incremental backups are applied on top of the ones they're based on."""
+        chain = self.get_backup_chain(name)
+        try:
+            initialized = self.initialized()
+        except ProvSysError:
+            initialized = False # inconsistent local state, which is about to be replaced anyway
+        if initialized and self.parse_backup_name(name)['tag'] != self.get_backup_tag():
+            raise IncomingIntegrityError("{}: backup belongs to another provisioning infrastructure".format(name))
+
+        state = {'processed': 0, 'position': 0, 'size': len(chain)}
+        for backup in chain:
+            with tarfile.open(OUT_PATH + backup, 'r:*') as tar_fd:
+                try:
+                    manifest = json.load(tar_fd.extractfile(BACKUP_MANIFEST))
+                except (KeyError, ValueError) as exc:
+                    raise IncomingIntegrityError("{}: backup lacks a valid manifest ({})".format(backup, exc))
+                if manifest['kind'] == 'full':
+                    self._restore_full(backup, tar_fd)
+                elif manifest['schema'] != len(DB_MIGRATIONS):
+                    raise IncomingIntegrityError("{}: incremental backup of another database schema version ({} vs. {})".format(backup, manifest['schema'], len(DB_MIGRATIONS)))
+                else:
+                    self._restore_incremental(backup, tar_fd, manifest['version'])
+            state['processed'] = state['position'] = state['processed'] + 1
+            progress and progress(state)
+        # changes from now on must neither be mistaken for ones contained in
+        # backups taken before the restore, nor be based on those
+        latest = max(backup['version'] for backup in map(self.parse_backup_name, self.get_backups()) if backup and backup['tag'] == self.get_backup_tag())
+        self.sql.begin()
+        try:
+            self.sql.execute("UPDATE `sets_seq` SET `value` = max(`value`, ?)", (latest + 1,), commit = False)
+            self.sql.executemany("INSERT INTO `backups` (`file`, `version`) VALUES (?, ?)", ((backup, self.parse_backup_name(backup)['version']) for backup in chain), commit = False)
+            self.sql.commit()
+        except:
+            self.sql.rollback()
+            raise
+        log.info("Backup {} restored".format(name))
+
+    def _restore_full(self, backup, tar_fd):
+        # files are extracted next to the current ones first and only then
+        # renamed, so a backup failing to be read leaves the local state as is
+        restored = []
+        try:
+            for member in tar_fd:
+                if member.name == BACKUP_MANIFEST:
+                    continue
+                if not member.isfile() or '/' in member.name or member.name.startswith('.'):
+                    raise IncomingIntegrityError("{}: unexpected file in backup".format(backup), member.name)
+                with open("{}.{}.restore".format(self.local_path, member.name), 'wb') as fd:
+                    restored.append(member.name)
+                    shutil.copyfileobj(tar_fd.extractfile(member), fd)
+        except (tarfile.TarError, EOFError) as exc:
+            raise IncomingIntegrityError("{}: can't read backup ({})".format(backup, exc))
+        except:
+            for local_file in restored:
+                remove("{}.{}.restore".format(self.local_path, local_file))
+            raise
+        self.sql.close()
+        for journal in ("-journal", "-wal", "-shm"):
+            # would otherwise be applied to the restored database
+            try:
+                remove(self.local_path_db + journal)
+            except OSError:
+                pass
+        for local_file in restored:
+            rename("{}.{}.restore".format(self.local_path, local_file), self.local_path + local_file)
+        self.cfg = {}
+        self.files = {}
+        self.validated = None
+        self.static_index = None
+        if self.check_consistency_local(force=True):
+            # compressed variants aren't part of backups
+            self.index_static_files()
+
+    def _restore_incremental(self, backup, tar_fd, version):
+        path = self.local_path + ".restore.db"
+        try:
+            with open(path, 'wb') as fd:
+                shutil.copyfileobj(tar_fd.extractfile(BACKUP_DB), fd)
+            self.sql.execute("ATTACH DATABASE ? AS `incremental`", (path,))
+            try:
+                columns = {}
+                for table in INCREMENTAL_KEYS:
+                    self.sql.execute("PRAGMA `incremental`.table_info(`{}`)".format(table))
+                    columns[table] = [column['name'] for column in self.sql.fetchall() if column['name'] != '_rowid']
+                self.sql.begin()
+                try:
+                    # devices moved to another set would otherwise collide on
+                    # `dev_id` while the sets are updated one after another
+                    self.sql.execute("UPDATE `sets` SET `dev_id` = NULL WHERE `dev_id` IN (SELECT `dev_id` FROM `incremental`.`sets` AS `restored` WHERE `restored`.`id` != `sets`.`id`)", commit = False)
+                    # a set changed since the previous backup gets its former
+                    # state overwritten, new ones are inserted with their rowid
+                    for table, keys in INCREMENTAL_KEYS.items():
+                        rowid = table == 'sets'
+                        self.sql.execute("INSERT INTO `{0}` ({1}{2}) SELECT {3}{2} FROM `incremental`.`{0}` WHERE 1 ON CONFLICT ({4}) DO UPDATE SET {5}".format(
+                            table,
+                            '`rowid`, ' if rowid else '',
+                            ', '.join('`{}`'.format(column) for column in columns[table]),
+                            '`_rowid`, ' if rowid else '',
+                            ', '.join('`{}`'.format(key) for key in keys),
+                            ', '.join('`{0}` = excluded.`{0}`'.format(column) for column in columns[table] if column not in keys),
+                        ), commit = False)
+                    # as set by the trigger on UPDATE instead
+                    self.sql.execute("UPDATE `sets` SET `modified_seq` = (SELECT `modified_seq` FROM `incremental`.`sets` AS `restored` WHERE `restored`.`id` = `sets`.`id`) WHERE `id` IN (SELECT `id` FROM `incremental`.`sets`)", commit = False)
+                    self.sql.execute("UPDATE `sets_seq` SET `value` = max(`value`, ?)", (version,), commit = False)
+                    self.sql.commit()
+                except:
+                    self.sql.rollback()
+                    raise
+            finally:
+                self.sql.execute("DETACH DATABASE `incremental`")
+        except (KeyError, sqlite3.DatabaseError) as exc:
+            raise IncomingIntegrityError("{}: can't apply incremental backup ({})".format(backup, exc))
+        finally:
+            try:
+                remove(path)
+            except OSError:
+                pass
 
     def import_set(self, set):
         if not self.initialized():
@@ -365,85 +1286,343 @@ class ProvSystem():
         raise NotImplemented()
 
     def reset(self):
-        for _endpoint_key, _endpoint_val in self.cfg['endpoints'].items():
+        # the config might not have been read (yet), see `import_batch()`
+        for _endpoint_key, _endpoint_val in self.cfg.get('endpoints', {}).items():
             for static_file in self.get_static_files():
-                try:
-                    remove("{}{}".format(LOCAL_PATH, static_file))
-                except:
-                    pass
+                for local_file in (static_file, static_file + GZIP_SUFFIX):
+                    try:
+                        remove("{}{}".format(self.local_path, local_file))
+                    except:
+                        pass
+        for local_file in (PROVCFG + GZIP_SUFFIX, PROVCFG + ".min" + GZIP_SUFFIX):
+            try:
+                remove(self.local_path + local_file)
+            except:
+                pass
         try:
-            remove(LOCAL_PATH_PROVCFG)
+            remove(self.local_path_provcfg)
         except:
             pass
         try:
-            remove(LOCAL_PATH_SECRET)
+            remove(self.local_path_secret)
         except:
             pass
+        for journal in ("", "-journal", "-wal", "-shm"):
+            try:
+                remove(self.local_path_db + journal)
+            except:
+                pass
         try:
-            remove(LOCAL_PATH_DB)
+            remove(self.local_path_static)
         except:
             pass
+        self.cfg = {}
+        self.validated = None
+        self.static_index = None
+
+    def _stream_batch(self, batch, dyn_files, state, progress=None):
+        """Read the archive `batch` in a single pass, yielding the ID and the
+        dynamic files (name and content) of every set for `import_batch()`.
+        Files of a set are expected to be stored next to each other (as any
+        tar of a directory tree does), so only the set currently read is held
+        in memory.
+        Without `dyn_files` the system is about to be initialized by `batch`:
+        its config is taken rather than compared, top-level files are staged
+        (see `initialize()`) and listed in `state['staged']`. Sets stored before
+        the config can't be checked then, so all of them are skipped and
+        `state['deferred']` is set, telling to read the archive once more.
+        `state` is updated with what was found, including the set yielded last,
+        the number of sets processed and how far (in bytes) the archive was read."""
+        def row(set_id, set1):
+            for dyn_file in dyn_files:
+                if dyn_file not in set1:
+                    raise IncomingIntegrityError("{}: set lacks file referenced in config".format(batch), "sets/{}/{}".format(set_id, dyn_file))
+            state['set'] = set_id
+            state['processed'] += 1
+            state['position'] = fd.tell()
+            progress and progress(state)
+            return set_id, [(dyn_file, set1[dyn_file]) for dyn_file in dyn_files]
+
+        def stage(name, member):
+            with open(self._staged_path(name), 'wb') as staged_fd:
+                state['staged'].append(name)
+                shutil.copyfileobj(tar_fd.extractfile(member), staged_fd)
+
+        initializing = dyn_files is None
+        if initializing:
+            state['staged'] = []
+        set_id = None
+        set1 = {}
+        state['processed'] = 0
+        state['size'] = getsize(IN_PATH + batch)
+        with open(IN_PATH + batch, 'rb') as fd, tarfile.open(fileobj=fd, mode='r|*') as tar_fd:
+            for member in tar_fd:
+                tar_fd.members = [] # TarFile keeps track of all members read so far, which we don't need
+                name = member.name[2:] if member.name.startswith('./') else member.name
+                path = name.split('/')
+                if name == PROVCFG and member.isfile():
+                    if initializing:
+                        stage(name, member)
+                        with open(self._staged_path(name), 'r') as cfg_fd:
+                            self.cfg = json.load(cfg_fd)
+                        dyn_files = self.get_dynamic_files()
+                    elif not self.diff_cfg(tar_fd.extractfile(member)):
+                        raise IncomingIntegrityError("{} vs {}: To be imported provisioning config file incompatible to current one".format(self.local_path_provcfg, "{}|config.json".format(batch)))
+                    state[PROVCFG] = True
+                    continue
+                if initializing and len(path) == 1 and member.isfile() and not name.startswith('.') and name not in state['staged']:
+                    # which static files there are is only known once the config was read
+                    if dyn_files is None or name == SECRET or name in self.get_static_files():
+                        stage(name, member)
+                    continue
+                if path[0] != 'sets':
+                    continue
+                state['sets'] = True
+                if len(path) < 2:
+                    continue
+                if initializing and (dyn_files is None or state.get('deferred')):
+                    state['deferred'] = True
+                    continue
+                if path[1] != set_id:
+                    if set_id is not None:
+                        yield row(set_id, set1)
+                    set_id = path[1]
+                    set1 = {}
+                if len(path) == 3 and member.isfile() and path[2] in dyn_files:
+                    set1[path[2]] = tar_fd.extractfile(member).read()
+            if set_id is not None:
+                yield row(set_id, set1)
+
+    def import_batch(self, batch, progress=None):
+        # `progress` - if given - gets called with the import state (see
+        # `_stream_batch()`) for every set processed.
+        # The very first batch initializes the system along the way, its
+        # config, secret and static files are read within the same pass.
+        initializing = not self.initialized()
+        if initializing:
+            if not exists(self.local_path):
+                makedirs(self.local_path)
+            self.initialize_db()
+        elif self.is_batch_already_imported(batch):
+            provmetrics.inc('yaps_imports_total', result='failed')
+            raise IncomingIntegrityError("{}: Batch already imported".format(batch))
 
-    def import_batch(self, batch):
-        self.check_consistency_incoming_batch(batch)
-        if not self.initialized():
+        # Consistency and compatibility of the archive are checked while
+        # streaming through it, all within one transaction, rolled back on failure.
+        state = {}
+        start = perf_counter()
+        self.sql.begin()
+        try:
+            # all sets of a batch share one change sequence number, see `get_sets()`
+            self.sql.execute("UPDATE `sets_seq` SET `value` = `value` + 1", commit = False)
+            seq = self.get_version()
             try:
-                self.initialize(batch)
-            except:
+                self._insert_batch(batch, None if initializing else self.get_dynamic_files(), seq, state, progress)
+                if initializing and state.get(PROVCFG):
+                    self.initialize(state['staged'])
+                    if state.get('deferred'):
+                        # sets were stored before the config, so read them now
+                        self._insert_batch(batch, self.get_dynamic_files(), seq, state, progress)
+            except sqlite3.IntegrityError as exc:
+                raise IncomingIntegrityError("{}: set conflicts with already imported data ({})".format(batch, exc), "sets/{}".format(state.get('set')))
+            except (tarfile.TarError, EOFError, OSError, ValueError) as exc:
+                raise IncomingIntegrityError("{}: expected it being a stage2 provisioning import archive ({})".format(IN_PATH + batch, exc))
+            if not (state.get(PROVCFG) and state.get('sets')):
+                raise IncomingIntegrityError("{}: expected it being a stage2 provisioning import archive".format(IN_PATH + batch))
+            self.sql.execute("INSERT INTO `imported_batches` (`batch`, `sets`) VALUES (?, ?)", (batch, state['processed']), commit = False)
+            self.sql.commit()
+        except:
+            self.sql.rollback()
+            provmetrics.inc('yaps_imports_total', result='failed')
+            if initializing:
+                for local_file in state.get('staged', []):
+                    try:
+                        remove(self._staged_path(local_file))
+                    except OSError:
+                        pass
+                self.sql.close()
                 self.reset()
-                raise # raise original exception to inform frontend about initial reason of failure
+            raise # raise original exception to inform frontend about initial reason of failure
+        provmetrics.inc('yaps_imports_total', result='done')
+        provmetrics.inc('yaps_import_sets_total', state['processed'])
+        provmetrics.inc('yaps_import_seconds_total', perf_counter() - start)
+
+    def _insert_batch(self, batch, dyn_files, seq, state, progress=None):
+        for set_id, files in self._stream_batch(batch, dyn_files, state, progress):
+            self.sql.execute("INSERT INTO `sets` (`id`, `batch`, `modified_seq`) VALUES (?, ?, ?)", (set_id, batch, seq), commit = False)
+            self.sql.executemany("INSERT INTO `files` (`set_id`, `name`, `imported_seq`, `digest`, `content`) VALUES (?, ?, ?, ?, ?)",
+                ((set_id, name, seq, sha256(content).digest(), content) for name, content in files),
+                commit = False,
+            )
+
+    def get_version(self):
+        """Current change sequence number, increasing with every modification of sets."""
+        # not committing, as it might be read within a transaction, see `backup()`
+        self.sql.execute("SELECT `value` FROM `sets_seq`", commit = False)
+        return self.sql.fetchone()[0]
+
+    def get_summary(self):
+        """Number of sets by state, determined via index rather than looking at every set."""
+        # version first, so changes happening meanwhile are reported next time
+        summary = {'version': self.get_version()}
+        self.sql.execute("SELECT count(*), count(`dev_id`) FROM `sets`")
+        summary['total'], summary['assigned'] = self.sql.fetchone()
+        summary['free'] = summary['total'] - summary['assigned']
+        # negative downloaded_cnt means provisioning was started but not completed, see `allocate_set()`
+        self.sql.execute("SELECT count(*) FROM `sets` INDEXED BY `sets_incomplete` WHERE `downloaded_cnt` < 0")
+        summary['incomplete'] = self.sql.fetchone()[0]
+        return summary
+
+    def get_sets(self, offset=0, limit=100, sort='id', order='asc', batch=None, state=None, search=None, since=None):
+        """A page of sets (meta data only), optionally filtered by `batch`,
+        `state` (see SET_STATES) and `search` (substring of id, device ID or
+        comment).
+        If `since` (a version as returned before) is given, only sets modified
+        afterwards are listed, in the order they were modified."""
+        if sort not in FACTORY_SET_FIELDS or order not in ('asc', 'desc') or (state and state not in SET_STATES):
+            raise ValueError("Unsupported sort order or filter")
+        where = []
+        values = []
+        if batch:
+            where.append("`batch` = ?")
+            values.append(batch)
+        if state:
+            where.append(SET_STATES[state])
+        if search:
+            where.append("(instr(`id`, ?) OR instr(`dev_id`, ?) OR instr(`comment`, ?))")
+            values += [search] * 3
+        if since is not None:
+            where.append("`modified_seq` > ?")
+            values.append(since)
+            order_by = "`modified_seq`"
         else:
-            self.check_compatibility_incoming_batch(batch)
-
-        if self.is_batch_already_imported(batch):
-            raise IncomingIntegrityError("{}: Batch already imported".format(batch))
-
-        with tarfile.open(IN_PATH + batch) as tar_fd:
-            prfx = './' if '.' in tar_fd.getnames() else ''
-            self.sql.begin()
-            try:
-                for file_in_tar in tar_fd.getmembers():
-                    set1 = {}
-                    if file_in_tar.name.startswith('{}sets/'.format(prfx)) and (file_in_tar.name.count('/') == 1): #TODO: find a way to only extract files in desired subdirectories - this is quite hackish
-                        _name = file_in_tar.name.split('{}sets/'.format(prfx))[1]
-                        for dyn_file in self.get_dynamic_files():
-                            set1[dyn_file] = tar_fd.extractfile("{}sets/{}/{}".format(prfx, _name, dyn_file)).read()
-                        self.sql.execute("INSERT INTO `sets` ({} `id`, `batch`) VALUES({} ?, ?)".format(
-                                ''.join(('`{}`, '.format(k)) for k in set1),
-                                '?, '*len(set1)
-                            ),
-                            (*set1.values(), _name, batch),
-                            commit = False,
-                            #tuple(set1.values()) + (_name, batch)
-                        )
-                self.sql.commit()
-            except:
-                self.sql.rollback()
+            order_by = "`{}` {}, `rowid`".format(sort, order.upper())
+        where = ("WHERE " + " AND ".join(where)) if where else ""
+
+        res = {'version': self.get_version(), 'offset': offset, 'limit': limit}
+        self.sql.execute("SELECT count(*) FROM `sets` {}".format(where), values)
+        res['total'] = self.sql.fetchone()[0]
+        self.sql.execute("SELECT {} FROM `sets` {} ORDER BY {} LIMIT ? OFFSET ?".format(
+                ', '.join('`{}`'.format(field) for field in FACTORY_SET_FIELDS),
+                where,
+                order_by,
+            ),
+            values + [limit, offset],
+        )
+        res['sets'] = [dict(zip(row.keys(), row)) for row in self.sql.fetchall()]
+        return res
+
+    def export_sets(self, cursor=None, batch=None, state=None, after=None, before=None, limit=None):
+        """Meta data (EXPORT_SET_FIELDS) of all sets ordered by ID, optionally
+        filtered by `batch`, `state` (see SET_STATES) and a window of
+        `downloaded_dt` (`after` inclusive, `before` exclusive, formatted the way
+        sqlite stores it), as a generator of dicts.
+        Sets are read page-wise by ID (keyset pagination) rather than all at
+        once, every page a query of its own, so neither memory usage nor locks
+        held depend on the number of sets. An export is resumed by passing the
+        ID of the last set received as `cursor`."""
+        if state and state not in SET_STATES:
+            raise ValueError("Unsupported filter")
+        where = []
+        values = []
+        if batch:
+            where.append("`batch` = ?")
+            values.append(batch)
+        if state:
+            where.append(SET_STATES[state])
+        if after:
+            where.append("`downloaded_dt` >= ?")
+            values.append(after)
+        if before:
+            where.append("`downloaded_dt` < ?")
+            values.append(before)
+        return self._export_sets(where, values, cursor, limit)
+
+    def _export_sets(self, where, values, cursor, limit):
+        query = "SELECT {} FROM `sets` WHERE {} ORDER BY `id` LIMIT ?".format(
+            ', '.join('`{}`'.format(field) for field in EXPORT_SET_FIELDS),
+            " AND ".join(["`id` > ?"] + where),
+        )
+        while limit is None or limit > 0:
+            page = EXPORT_PAGE if limit is None else min(limit, EXPORT_PAGE)
+            # fetched as a whole, so the caller might query meanwhile
+            self.sql.execute(query, [cursor if cursor is not None else ''] + values + [page])
+            rows = self.sql.fetchall()
+            for row in rows:
+                yield dict(zip(row.keys(), row))
+            if len(rows) < page:
+                return
+            cursor = rows[-1]['id']
+            if limit is not None:
+                limit -= page
 
     def set_dev_params(self, dev_id, prod_id, fw_ver):
         self.dev_id = dev_id
         self.prod_id = prod_id
         self.fw_ver = fw_ver
 
-    def fetch_set(self, increment):
+    def allocate_set(self):
         # This might need some explanation:
-        # `increment` tells whether we want to increment the download_cnt field.
-        # We don't want to increment it for every request, but only for a full and completed request.
+        # We don't want to increment the download_cnt field for every request, but only for a full and completed request.
         # To keep track if a request was initiated (but not yet completed) we increment and negate download_cnt and keep it that way, until download_cnt becomes positive again, which happens when `completed_set` was called.
         # So, a negative download_cnt indicates the last provisioning process wasn't completed.
-        # Furthermore, we want - if a set was already assigned to a device (`dev_id`) - to select that one, otherwise a non-assigned, by:
-        # ('`dev_id` = ? OR `dev_id` IS NULL ORDER BY `dev_id` DESC LIMIT 1').
+        # Furthermore, we want - if a set was already assigned to a device (`dev_id`) - to select that one, otherwise the first non-assigned one.
+        # Both are looked up via index (`dev_id` is unique, free sets are tracked by the partial index `sets_free`), so allocating is O(log n) regardless of the size of the pool.
+        # Doing it all within a single statement keeps it atomic without the need of an explicit transaction:
+        # concurrent allocations are serialized by sqlite's write lock, each one evaluating the free list anew.
+        # This is the only statement of the device API writing to the database
+        # besides `completed_set`, so it's only supposed to be called once per
+        # provisioning process (`getConfig`) - everything else uses `lookup_set`.
+
+        self.sql.execute_retry("UPDATE `sets` SET `dev_id` = ?, `prod_id` = ?, `fw_ver` = ?, `downloaded_cnt` = (CASE WHEN downloaded_cnt>=0 THEN -1*(abs(downloaded_cnt)+1) ELSE downloaded_cnt END), `downloaded_dt` = datetime('now') WHERE `rowid` = coalesce((SELECT `rowid` FROM `sets` WHERE `dev_id` = ?), (SELECT `rowid` FROM `sets` INDEXED BY `sets_free` WHERE `dev_id` IS NULL ORDER BY `rowid` LIMIT 1))", (self.dev_id, self.prod_id, self.fw_ver, self.dev_id))
+
+    def lookup_set(self, columns):
+        """Read-only counterpart to `allocate_set`: fetch only `columns` of the set
+        assigned to the device, or `None` if there is none.
+        Columns naming dynamic files are read from `files`, only the ones asked for."""
+        dyn_files = [column for column in columns if column in self.get_dynamic_files()]
+        fields = [column for column in columns if column not in dyn_files]
+        set1 = {}
+        if fields:
+            self.sql.execute("SELECT {} FROM `sets` WHERE `dev_id` = ? LIMIT 1".format(
+                    ', '.join('`{}`'.format(column) for column in fields)
+                ),
+                (self.dev_id,),
+                commit = False,
+            )
+            row = self.sql.fetchone()
+            if not row:
+                return None
+            set1.update(zip(row.keys(), row))
+        if dyn_files:
+            self.sql.execute("SELECT `name`, `content` FROM `files` WHERE `set_id` = (SELECT `id` FROM `sets` WHERE `dev_id` = ?) AND `name` IN ({})".format(
+                    ', '.join('?' * len(dyn_files))
+                ),
+                (self.dev_id, *dyn_files),
+                commit = False,
+            )
+            files = {row['name']: row['content'] for row in self.sql.fetchall()}
+            if not files:
+                return None
+            for dyn_file in dyn_files:
+                if dyn_file not in files:
+                    raise LocalIntegrityError("{}: file missing in database".format(dyn_file))
+            set1.update(files)
+        return set1
 
-        self.sql.execute("UPDATE `sets` SET `dev_id` = ?, `prod_id` = ?, `fw_ver` = ?, `downloaded_cnt` = (CASE WHEN downloaded_cnt>=0 THEN -1*(abs(downloaded_cnt)+1) ELSE downloaded_cnt END), `downloaded_dt` = datetime('now') WHERE `dev_id` = ? OR `dev_id` IS NULL ORDER BY `dev_id` DESC LIMIT 1", (self.dev_id, self.prod_id, self.fw_ver, self.dev_id))
-        self.sql.execute("SELECT * FROM `sets` WHERE `dev_id` = ? LIMIT 1", (self.dev_id,))
-        set1 = self.sql.fetchone()
+    def fetch_set(self, increment):
+        # `increment` tells whether we want to (re)allocate the set, see `allocate_set`.
+        # Either way only meta data is returned, dynamic files are to be fetched
+        # on demand via `lookup_set`.
+        if increment:
+            self.allocate_set()
+        set1 = self.lookup_set(FACTORY_SET_FIELDS)
         if set1:
-            set1 =  dict(zip(set1.keys(), set1))
-            set1['purge_code'] = sha256(self.dev_id.encode('utf-8') + self.read_file(LOCAL_PATH_SECRET, binary=True)).hexdigest()
+            set1['purge_code'] = sha256(self.dev_id.encode('utf-8') + self.get_secret()).hexdigest()
         return set1
 
     def completed_set(self):
-        self.sql.execute("UPDATE `sets` SET `downloaded_cnt` = abs(downloaded_cnt) WHERE `dev_id` = ? LIMIT 1", (self.dev_id,))
+        self.sql.execute_retry("UPDATE `sets` SET `downloaded_cnt` = abs(downloaded_cnt) WHERE `dev_id` = ?", (self.dev_id,))
         #TODO: confirm changes
 
     def comment_set(self, id, comment):
@@ -458,19 +1637,136 @@ class ProvSystem():
         self.sql.execute("UPDATE `sets` SET `dev_id` = ? WHERE `id` = ? AND (`dev_id` IS NULL)", (dev_id, id))
         #TODO: confirm changes
 
+    def bulk_assign(self, rows, dry_run=False):
+        """Assign sets to devices and/or comment sets in bulk. `rows` are dicts
+        of `id` (a set, or empty resp. BULK_ANY for the next free one), `dev_id`
+        and `comment`, each optional but a device or comment being required.
+        All rows are applied within a single transaction, which is rolled back
+        if any row failed - or in any case given `dry_run`, in order to learn
+        what would happen. Returns whether it got applied and a result per row."""
+        results = []
+        self.sql.begin(immediate=True)
+        try:
+            for row in rows:
+                results.append(self._bulk_assign_row(row))
+            failed = sum(res['result'] == 'failed' for res in results)
+            if failed or dry_run:
+                self.sql.rollback()
+            else:
+                self.sql.commit()
+        except:
+            self.sql.rollback()
+            raise
+        return {'dry_run': dry_run, 'applied': not (failed or dry_run), 'total': len(results), 'failed': failed, 'results': results}
+
+    def _bulk_assign_row(self, row):
+        set_id = row.get('id') or None
+        set_id = None if set_id == BULK_ANY else set_id
+        dev_id = row.get('dev_id') or None
+        comment = row.get('comment') or None # empty cells don't clear comments
+        res = {'id': set_id, 'dev_id': dev_id, 'result': 'unchanged', 'error': None}
+        def failed(msg):
+            res.update(result='failed', error=msg)
+            return res
+
+        if not (set_id or dev_id):
+            return failed("neither set nor device given")
+        if not (dev_id or comment):
+            return failed("neither device nor comment given")
+        if dev_id:
+            self.sql.execute("SELECT `id` FROM `sets` WHERE `dev_id` = ?", (dev_id,), commit = False)
+            current = self.sql.fetchone()
+            if current and set_id and current['id'] != set_id:
+                return failed("device has set {} assigned already".format(current['id']))
+            if current:
+                set_id = current['id']
+            elif set_id:
+                self.sql.execute("UPDATE `sets` SET `dev_id` = ? WHERE `id` = ? AND `dev_id` IS NULL", (dev_id, set_id), commit = False)
+                if not self.sql.rows_affected():
+                    self.sql.execute("SELECT `dev_id` FROM `sets` WHERE `id` = ?", (set_id,), commit = False)
+                    other = self.sql.fetchone()
+                    return failed("set is assigned to {} already".format(other['dev_id']) if other else "no such set")
+                res['result'] = 'assigned'
+            else:
+                # next free set, just like `allocate_set()`
+                self.sql.execute("UPDATE `sets` SET `dev_id` = ? WHERE `rowid` = (SELECT `rowid` FROM `sets` INDEXED BY `sets_free` WHERE `dev_id` IS NULL ORDER BY `rowid` LIMIT 1)", (dev_id,), commit = False)
+                if not self.sql.rows_affected():
+                    return failed("no free sets left")
+                self.sql.execute("SELECT `id` FROM `sets` WHERE `dev_id` = ?", (dev_id,), commit = False)
+                set_id = self.sql.fetchone()['id']
+                res['result'] = 'assigned'
+            res['id'] = set_id
+        if comment:
+            self.sql.execute("UPDATE `sets` SET `comment` = ? WHERE `id` = ?", (comment, set_id), commit = False)
+            if not self.sql.rows_affected():
+                return failed("no such set")
+            if res['result'] == 'unchanged':
+                res['result'] = 'commented'
+        return res
+
+    def bulk_reset(self, batch=None, dev_ids=None, state=None, dry_run=False):
+        """Take sets back from the devices they're assigned to, in bulk:
+        selected by `batch`, `dev_ids` (a list) and/or `state` (see SET_STATES,
+        e.g. `incomplete` for devices which didn't complete provisioning) - all
+        of those given must match.
+        Applied within a single transaction (rolled back given `dry_run`),
+        returns the sets reset as well as devices which had none assigned."""
+        if not (batch or dev_ids or state):
+            raise ValueError("Expected batch, devices or state to select sets by")
+        if state and state not in SET_STATES:
+            raise ValueError("Unsupported state")
+        where = ["`dev_id` IS NOT NULL"]
+        values = []
+        if batch:
+            where.append("`batch` = ?")
+            values.append(batch)
+        if state:
+            where.append(SET_STATES[state])
+        results = []
+        self.sql.begin(immediate=True)
+        try:
+            if dev_ids:
+                # rather than binding thousands of values to a single statement
+                self.sql.execute("CREATE TEMP TABLE `bulk_devices` (`dev_id` TEXT PRIMARY KEY)", commit = False)
+                self.sql.executemany("INSERT OR IGNORE INTO `bulk_devices` (`dev_id`) VALUES (?)", ((dev_id,) for dev_id in dev_ids), commit = False)
+                where.append("`dev_id` IN (SELECT `dev_id` FROM `temp`.`bulk_devices`)")
+            self.sql.execute("SELECT `id`, `dev_id` FROM `sets` WHERE {} ORDER BY `rowid`".format(" AND ".join(where)), values, commit = False)
+            results = [{'id': row['id'], 'dev_id': row['dev_id'], 'result': 'reset', 'error': None} for row in self.sql.fetchall()]
+            self.sql.executemany("UPDATE `sets` SET `dev_id` = NULL WHERE `id` = ?", ((res['id'],) for res in results), commit = False)
+            if dev_ids:
+                self.sql.execute("DROP TABLE `temp`.`bulk_devices`", commit = False)
+            if dry_run:
+                self.sql.rollback()
+            else:
+                self.sql.commit()
+        except:
+            self.sql.rollback()
+            raise
+        found = {res['dev_id'] for res in results}
+        for dev_id in dict.fromkeys(dev_ids or []):
+            if dev_id not in found:
+                results.append({'id': None, 'dev_id': dev_id, 'result': 'unchanged', 'error': "no set assigned{}".format(" matching" if batch or state else "")})
+        return {'dry_run': dry_run, 'applied': not dry_run, 'total': len(found), 'results': results}
+
 
 class ProvisioningError(ProvSysError):
     """Derived Exception for high level handling of provisioning errors.
     Supposed to be passed directly to devices to be handled"""
 
 class Provisioning():
-    def __init__(self, dev_id, prod_id, fw_ver):
-        self.provsys = ProvSystem()
-        if not self.provsys.check_consistency_local():
-            raise Uninitialized("The provisioning system is not yet initialized")
-        self.provsys.parse_config()
+    def __init__(self, dev_id, prod_id, fw_ver, system=None, store=None):
+        # `system` allows long running callers to pass in a `ProvSystem` they
+        # already checked for consistency and keep around between requests,
+        # otherwise one for `store` (see `select_store()`) is set up.
+        if system:
+            self.provsys = system
+        else:
+            self.provsys = ProvSystem(store)
+            if not self.provsys.check_consistency_local():
+                raise Uninitialized("The provisioning system is not yet initialized")
         self.cfg = self.provsys.cfg
         self.provsys.set_dev_params(dev_id, prod_id, fw_ver)
+        self.set = {}
         #if dev_id:
         #    self.fetch_set(dev_id, prod_id, fw_ver)
 
@@ -480,18 +1776,33 @@ class Provisioning():
     def fetch_set(self, increment = False):
         self.set = self.provsys.fetch_set(increment)
         if not self.set:
-            raise NoFree("No unassigned provisioning sets available")
+            if increment:
+                provmetrics.inc('yaps_allocation_failures_total')
+                raise NoFree("No unassigned provisioning sets available")
+            raise NotAssigned("No provisioning set assigned to this device, call getConfig first")
+        if increment:
+            provmetrics.inc('yaps_allocations_total')
+
+    def lookup(self, *columns):
+        """Values of `columns` of the set assigned to the device, fetched
+        read-only and only once per instance."""
+        missing = [column for column in columns if column not in self.set]
+        if missing:
+            set1 = self.provsys.lookup_set(missing)
+            if not set1:
+                raise NotAssigned("No provisioning set assigned to this device, call getConfig first")
+            self.set.update(set1)
+        return [self.set[column] for column in columns]
 
     def fetch_hash(self):
-        return sha256(self.provsys.dev_id.encode('utf-8') + self.provsys.read_file(LOCAL_PATH_SECRET, binary=True)).hexdigest()
+        return sha256(self.provsys.dev_id.encode('utf-8') + self.provsys.get_secret()).hexdigest()
 
     def fetch_config(self):
         self.fetch_set(True)
         return self.cfg
 
     def read_file(self, file_path):
-        self.fetch_set()
-        return self.provsys.read_file("{}/{}".format(LOCAL_PATH, file_path), binary=True)
+        return self.provsys.read_local_file(file_path)
 
     def set_done(self):
         self.fetch_set()
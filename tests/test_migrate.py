@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Migrating a database of an earlier version (see `DB_MIGRATIONS`) from several
+# connections at the same time, as concurrent requests after an upgrade do.
+
+import sys
+from os import remove
+from os.path import abspath, dirname, join
+import sqlite3
+import threading
+import unittest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'bench'))
+import benchlib
+
+provsys, PREFIX = benchlib.setup()
+
+SETS = 200
+CONNECTIONS = 4
+
+def write_baseline_db(system):
+    """Replace the database of `system` by one as created by the very first
+    version: dynamic files as columns of `sets`, schema version 0."""
+    system.sql.close()
+    for journal in ("", "-journal", "-wal", "-shm"):
+        try:
+            remove(system.local_path_db + journal)
+        except OSError:
+            pass
+    dyn_files = system.get_dynamic_files()
+    columns = ['"{}" {}'.format(col, ' '.join(prop)) for col, prop in provsys.FACTORY_SET_FIELDS.items()]
+    columns += ['"{}" BINARY UNIQUE NOT NULL'.format(dyn_file) for dyn_file in dyn_files]
+    conn = sqlite3.connect(system.local_path_db)
+    conn.execute("CREATE TABLE `sets` ( {} )".format(', '.join(columns)))
+    conn.executemany("INSERT INTO `sets` (`id`, `batch`, {}) VALUES (?, 'baseline', {})".format(
+        ', '.join('`{}`'.format(dyn_file) for dyn_file in dyn_files),
+        ', '.join('?' for _ in dyn_files),
+    ), (["{:08d}".format(i)] + [bytes("{}/{}".format(i, dyn_file), 'utf-8') for dyn_file in dyn_files] for i in range(SETS)))
+    conn.commit()
+    conn.close()
+
+class TestMigrate(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        benchlib.write_batch(provsys.IN_PATH + "migrate.tgz", benchlib.DEFAULT_CFG, 1)
+        provsys.ProvSystem().import_batch("migrate.tgz")
+
+    def setUp(self):
+        system = provsys.ProvSystem()
+        system.parse_config()
+        write_baseline_db(system)
+
+    def test_concurrent(self):
+        systems = [provsys.ProvSystem() for _ in range(CONNECTIONS)]
+        for system in systems:
+            system.parse_config()
+        barrier = threading.Barrier(CONNECTIONS)
+        errors = []
+        def migrate(system):
+            barrier.wait()
+            try:
+                system.migrate_db()
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                system.sql.close()
+        threads = [threading.Thread(target=migrate, args=(system,)) for system in systems]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        system = provsys.ProvSystem()
+        system.parse_config()
+        system.sql.execute("PRAGMA user_version")
+        self.assertEqual(system.sql.fetchone()[0], len(provsys.DB_MIGRATIONS))
+        system.sql.execute("SELECT count(*) FROM `sets_seq`")
+        self.assertEqual(system.sql.fetchone()[0], 1)
+        system.sql.execute("SELECT count(*) FROM `files`")
+        self.assertEqual(system.sql.fetchone()[0], SETS * len(system.get_dynamic_files()))
+        system.sql.execute("SELECT `batch`, `sets` FROM `imported_batches`")
+        self.assertEqual([tuple(row) for row in system.sql.fetchall()], [('baseline', SETS)])
+
+if __name__ == '__main__':
+    unittest.main()